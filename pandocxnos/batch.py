@@ -0,0 +1,278 @@
+"""batch.py: runs pandoc-xnos filters on many pandoc json files.
+
+Usage:
+
+    pandoc-xnos-batch [-t FORMAT] -o OUTDIR [-m MANIFEST] [-j N] [PATH ...]
+
+Each PATH is a pandoc json file (e.g., from "pandoc -t json"), or a
+directory that is searched for *.json files.  A MANIFEST file lists more
+paths, one per line, relative to the MANIFEST's directory.  Each document is filtered for output FORMAT and
+written to OUTDIR under the same name (relative to its directory, if one was
+given).  The input files are never overwritten, and no two documents may be
+written to the same file.  The filtered files may then be converted using
+"pandoc -f json".
+
+The plugins are chosen as for pandoc-xnos (see host.py).  They are loaded
+once, and each document starts with the same state that it would have in a
+filter process of its own.  Plugins that only provide main() may keep state
+of their own, and so where they are used each document is filtered in a
+process forked for it (or, where processes can't be forked, the plugins are
+reloaded).  Use -j to filter the documents in N processes at a time.
+"""
+
+# Copyright 2016 Thomas J. Duck.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import io
+import argparse
+import importlib
+import collections
+
+from . import host
+from .core import STDERR
+from .core import _fork_executor  # pylint: disable=protected-access
+
+
+# find_files() ---------------------------------------------------------------
+
+def find_files(paths, outdir):
+    """Returns a list of (src, dst) tuples for the pandoc json files given
+    by the 'paths'.  Directories are searched for *.json files.  The 'dst'
+    filenames are in 'outdir'.
+
+    A RuntimeError is raised if a 'dst' is the same as its 'src', or if two
+    files would be written to the same 'dst'."""
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith('.json'):
+                        src = os.path.join(dirpath, filename)
+                        files.append((src, os.path.relpath(src, path)))
+        else:
+            files.append((path, os.path.basename(path)))
+
+    files = [(src, os.path.join(outdir, name)) for src, name in files]
+
+    srcs = {}  # Maps the destinations to their sources
+    for src, dst in files:
+        key = os.path.normcase(os.path.abspath(dst))
+        if key == os.path.normcase(os.path.abspath(src)):
+            raise RuntimeError('%s would be overwritten' % src)
+        if key in srcs:
+            raise RuntimeError('%s and %s would both be written to %s' % \
+                               (srcs[key], src, dst))
+        srcs[key] = src
+
+    return files
+
+
+# run_batch() ----------------------------------------------------------------
+
+def _filter_file(src, dst, fmt, plugins, state):
+    """Filters the file 'src' to 'dst' for output format 'fmt' with the
+    'plugins', starting from the core.py 'state'.  Returns None, or an error
+    message."""
+
+    try:
+        with io.open(src, encoding='utf-8') as f:
+            text = f.read()
+        host._set_state(state)  # pylint: disable=protected-access
+        text = host.run_plugins(text, fmt, plugins)
+
+        # Write a temporary file so that 'dst' isn't lost if this fails
+        dirname = os.path.dirname(dst)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:  # Made by another process
+                if not os.path.isdir(dirname):
+                    raise
+        tmp = '%s.%d.tmp' % (dst, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.rename(tmp, dst)
+
+    except (Exception, SystemExit) as e:  # pylint: disable=broad-except
+        return '%s: %s' % (src, e)
+
+    return None
+
+def _filter_reloaded(src, dst, fmt, plugins, state):
+    """Filters the file 'src' to 'dst' as _filter_file() does, but first
+    reloads the plugins that only provide main(), so that the state they
+    keep doesn't carry over from one file to the next.  Returns None, or an
+    error message."""
+    plugins = [plugin if hasattr(plugin, 'filter_doc') else \
+               importlib.reload(plugin) for plugin in plugins]
+    return _filter_file(src, dst, fmt, plugins, state)
+
+def _start_forked(src, dst, fmt, plugins, state):
+    """Starts filtering the file 'src' to 'dst' as _filter_file() does in a
+    process forked for it.  Returns the process id and the file descriptor
+    from which the error message is read (see _finish_forked())."""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 1
+        try:
+            error = _filter_file(src, dst, fmt, plugins, state)
+            with os.fdopen(wfd, 'wb') as f:
+                f.write((error or '').encode('utf-8'))
+            status = 0
+        finally:
+            STDERR.flush()
+            os._exit(status)  # pylint: disable=protected-access
+    os.close(wfd)
+    return pid, rfd
+
+def _finish_forked(src, pid, rfd):
+    """Waits for the process 'pid' filtering the file 'src' to finish.
+    Returns None, or the error message read from 'rfd'."""
+    with os.fdopen(rfd, 'rb') as f:
+        error = f.read().decode('utf-8')
+    _, status = os.waitpid(pid, 0)
+    if status and not error:
+        error = '%s: Filter process failed' % src
+    return error or None
+
+def _run_forked(files, processes, fmt, plugins, state):
+    """Filters the 'files' with each in a process forked for it, and with up
+    to 'processes' processes at a time.  The state kept by plugins that only
+    provide main() then doesn't carry over from one file to the next.
+    Returns the errors."""
+    errors = []
+    running = collections.deque()  # (src, pid, rfd) tuples in file order
+    for src, dst in files:
+        if len(running) >= processes:
+            errors.append(_finish_forked(*running.popleft()))
+        running.append((src,) + _start_forked(src, dst, fmt, plugins, state))
+    while running:
+        errors.append(_finish_forked(*running.popleft()))
+    return errors
+
+_SHARED = None  # (fmt, plugins, state) in a forked process
+
+def _init_shared(*shared):
+    """Stores what is 'shared' with a forked process."""
+    global _SHARED  # pylint: disable=global-statement
+    _SHARED = shared
+
+def _filter_shared(src, dst):
+    """Filters the file 'src' to 'dst' in a forked process using what is
+    shared with it.  Returns None, or an error message."""
+    fmt, plugins, state = _SHARED  # pylint: disable=unpacking-non-sequence
+    return _filter_file(src, dst, fmt, plugins, state)
+
+def _run_parallel(files, processes, shared):
+    """Filters the 'files' using a pool of forked processes that are given
+    the 'shared' (fmt, plugins, state) tuple.  Each process filters many
+    files, and so this is only for plugins that provide filter_doc().
+    Returns the errors, or None if this couldn't be done."""
+
+    executor = _fork_executor(processes, _init_shared, shared)
+    if executor is None:
+        return None
+    with executor:
+        futures = [executor.submit(_filter_shared, src, dst)
+                   for src, dst in files]
+        return [future.result() for future in futures]
+
+def run_batch(files, fmt, plugins=None, processes=1):
+    """Filters the list of (src, dst) 'files' for output format 'fmt' with
+    the 'plugins', which default to those given by host.load_plugins().
+    The files are filtered in parallel if 'processes' is more than 1.
+    Returns a list of error messages for the files that failed."""
+
+    if plugins is None:
+        plugins = host.load_plugins()
+
+    state = host._get_state()  # pylint: disable=protected-access
+
+    # Plugins that only provide main() are isolated by forking a process
+    # for each file (which is also how they are run in parallel), or else
+    # by reloading them
+    isolate = not all(hasattr(plugin, 'filter_doc') for plugin in plugins)
+
+    errors = None
+    if isolate and hasattr(os, 'fork'):
+        errors = _run_forked(files, max(processes, 1), fmt, plugins, state)
+    elif isolate:
+        errors = [_filter_reloaded(src, dst, fmt, plugins, state)
+                  for src, dst in files]
+    elif processes > 1 and len(files) > 1:
+        errors = _run_parallel(files, processes, (fmt, plugins, state))
+    if errors is None:
+        errors = [_filter_file(src, dst, fmt, plugins, state)
+                  for src, dst in files]
+    host._set_state(state)  # pylint: disable=protected-access
+
+    return [error for error in errors if error]
+
+
+# main() ---------------------------------------------------------------------
+
+def main():
+    """Filters the files named on the command line."""
+
+    parser = argparse.ArgumentParser(
+        description='Runs pandoc-xnos filters on pandoc json files.')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='a pandoc json file or a directory of them')
+    parser.add_argument('-t', '--to', default='', metavar='FORMAT',
+                        help='the output format (e.g., html)')
+    parser.add_argument('-o', '--output', metavar='OUTDIR', required=True,
+                        help='the directory to write to')
+    parser.add_argument('-m', '--manifest', metavar='MANIFEST',
+                        help='a file listing paths, one per line, relative '
+                        'to its directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='the number of processes to use')
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    if args.manifest:
+        dirname = os.path.dirname(args.manifest)
+        with io.open(args.manifest, encoding='utf-8') as f:
+            paths.extend(os.path.join(dirname, line.strip())
+                         for line in f if line.strip())
+    if not paths:
+        parser.error('no files given')
+
+    try:
+        files = find_files(paths, args.output)
+    except RuntimeError as e:
+        parser.error(str(e))
+    errors = run_batch(files, args.to, processes=args.jobs)
+
+    prog = os.path.basename(sys.argv[0])
+    for error in errors:
+        STDERR.write('%s: %s\n' % (prog, error))
+    STDERR.write('%s: %d of %d files filtered\n' % \
+                 (prog, len(files) - len(errors), len(files)))
+    STDERR.flush()
+
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,17 @@ given in the function docstrings.
 
   * `init()` - Determines and returns the pandoc version
   * `get_meta()` - Retrieves variables from a document's metadata
+  * `get_metadata()` - Returns a Metadata object that decodes a
+                       document's xnos-* variables once
+  * `load_doc()`/`dump_doc()` - Reads/writes a document using the
+                                fastest json codec available
+  * `acts_on()` - Declares the elements that an action acts upon
+  * `walk_actions()` - Applies a list of actions in as few walks as
+                       possible
+  * `filter_stream()` - Filters a document from STDIN to STDOUT one
+                        block at a time
+  * `get_profile()` - Enables profiling of the actions and returns
+                      the Profile
 
 #### Element list functions ####
 
@@ -22,6 +33,14 @@ given in the function docstrings.
   * `dollarfy()` - Changes Math elements to dollared strings
   * `extract_attrs()` - Extracts attribute strings
 
+#### Classes ####
+
+  * `DocumentContext` - Holds the state kept while processing a
+                        document
+  * `LabelRegistry` - Indexes labels and their numbers
+  * `BlockCache` - Caches the results of local actions on disk
+  * `Profile` - Records the calls to and time taken by actions
+
 #### Actions and their factory functions ####
 
   * `join_strings()` - Joins adjacent strings in a pandoc document
@@ -58,19 +77,19 @@ given in the function docstrings.
 import os
 import sys
 import io
-import subprocess
 import re
-import textwrap
+import time
+import json
 import functools
-import copy
-
-import psutil
+import collections
 
 from pandocfilters import Str, Space, Math, RawInline, RawBlock, Link
 from pandocfilters import walk, stringify
-from pandocfilters import elt as _elt
 
-from pandocattributes import PandocAttributes
+# Every filter process imports this module, and so its import time is paid on
+# each pandoc run.  Modules that are needed only on some code paths
+# (subprocess, psutil, pandocattributes and textwrap) are imported where
+# they are used.
 
 
 #=============================================================================
@@ -81,6 +100,95 @@ from pandocattributes import PandocAttributes
 # pylint: disable=undefined-variable
 STRTYPES = [str] if sys.version_info > (3,) else [str, unicode]
 
+class _LazyStream(io.TextIOBase):
+    """A UTF-8 text stream around one of sys.stdin/stdout/stderr.  The
+    wrapper is only made when the stream is first used.  The methods and
+    properties of io.TextIOBase are passed on to it, as are any other
+    attributes (e.g., line_buffering)."""
+
+    # pylint: disable=missing-docstring
+
+    def __init__(self, name):
+        io.TextIOBase.__init__(self)
+        self._name = name
+        self._stream = None
+
+    def _get_stream(self):
+        """Returns the wrapped stream, making it if needed."""
+        if self._stream is None:
+            self._stream = io.TextIOWrapper(getattr(sys, self._name).buffer,
+                                            'utf-8', 'strict')
+        return self._stream
+
+    def __getattr__(self, name):
+        return getattr(self._get_stream(), name)
+
+    def read(self, size=-1):
+        return self._get_stream().read(size)
+
+    def readline(self, size=-1):
+        return self._get_stream().readline(size)
+
+    def __next__(self):
+        return next(self._get_stream())
+
+    def write(self, s):
+        return self._get_stream().write(s)
+
+    def flush(self):
+        self._get_stream().flush()
+
+    def close(self):
+        if self._stream is not None:  # Nothing to close otherwise
+            self._stream.close()
+
+    @property
+    def closed(self):
+        return self._stream is not None and self._stream.closed
+
+    def fileno(self):
+        return self._get_stream().fileno()
+
+    def isatty(self):
+        return self._get_stream().isatty()
+
+    def readable(self):
+        return self._get_stream().readable()
+
+    def writable(self):
+        return self._get_stream().writable()
+
+    def seekable(self):
+        return self._get_stream().seekable()
+
+    def seek(self, offset, whence=0):
+        return self._get_stream().seek(offset, whence)
+
+    def tell(self):
+        return self._get_stream().tell()
+
+    def truncate(self, pos=None):
+        return self._get_stream().truncate(pos)
+
+    def detach(self):
+        return self._get_stream().detach()
+
+    @property
+    def encoding(self):
+        return self._get_stream().encoding
+
+    @property
+    def errors(self):
+        return self._get_stream().errors
+
+    @property
+    def newlines(self):
+        return self._get_stream().newlines
+
+    @property
+    def buffer(self):
+        return self._get_stream().buffer
+
 # Pandoc uses UTF-8 for both input and output; so must its filters.  This is
 # handled differently depending on the python version.
 if sys.version_info > (3,):
@@ -88,9 +196,9 @@ if sys.version_info > (3,):
     # Character encoding/decoding is performed automatically at stream
     # interfaces: https://stackoverflow.com/questions/16549332/.
     # Set it to UTF-8 for all streams.
-    STDIN = io.TextIOWrapper(sys.stdin.buffer, 'utf-8', 'strict')
-    STDOUT = io.TextIOWrapper(sys.stdout.buffer, 'utf-8', 'strict')
-    STDERR = io.TextIOWrapper(sys.stderr.buffer, 'utf-8', 'strict')
+    STDIN = _LazyStream('stdin')
+    STDOUT = _LazyStream('stdout')
+    STDERR = _LazyStream('stderr')
 else:
     # Py2 strings are ASCII bytes.  Encoding/decoding is handled separately.
     # See: https://docs.python.org/2/howto/unicode.html.
@@ -98,6 +206,8 @@ else:
     STDOUT = sys.stdout
     STDERR = sys.stdout
 
+# The globals below hold the state of the default DocumentContext.
+
 # Privately flags that cleveref TeX needs to be written into the doc
 _CLEVEREFTEX = False
 
@@ -105,6 +215,27 @@ _CLEVEREFTEX = False
 MAXLEVEL = 1  # The maximum level header to track
 SEC = [0]     # Expand dynamically if needed
 
+# Keys for the block elements (LineBlock is new in pandoc 1.18 and Figure
+# in pandoc 3.0)
+_BLOCKKEYS = frozenset(['Plain', 'Para', 'LineBlock', 'CodeBlock',
+                        'RawBlock', 'BlockQuote', 'OrderedList', 'BulletList',
+                        'DefinitionList', 'Header', 'HorizontalRule', 'Table',
+                        'Figure', 'Div', 'Null'])
+
+# Keys for the elements that hold references
+_CITEKEYS = frozenset(['Cite'])
+
+# Dispatch table for actions that process inline element lists.  Maps the
+# keys of elements that hold inline element lists to functions that return
+# the lists.  The table used depends upon the pandoc version (see
+# _ASTAdapter); this one is for all versions before pandoc 2.10.
+_INLINELISTS = {
+    'Para': lambda value: value,
+    'Plain': lambda value: value,
+    'Image': lambda value: value[-2],
+    'Table': lambda value: value[-5]
+}
+
 
 #=============================================================================
 # Decorators
@@ -120,27 +251,304 @@ def _repeat(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """Repeats the call until True is returned."""
-        ret = None
+        ret = func(*args, **kwargs)
         while ret is None:
+            if _PROFILE is not None:
+                _PROFILE.restart()
             ret = func(*args, **kwargs)
         return ret
     return wrapper
 
 
+# _scan() --------------------------------------------------------------------
+
+# The _scan decorator drives a cursor through an element list.  The decorated
+# function func(x, i, ...) scans the list 'x' from index 'i', edits it in
+# place, and returns the index at which scanning should resume.  None is
+# returned once the end of the list is reached.  Unlike _repeat(), processing
+# never restarts from the beginning of the list, and so the time taken is
+# linear in the length of the list.  Resuming the scan isn't a restart, and
+# so isn't recorded by the Profile.
+
+def _scan(func):
+    """Repeats func(x, i, ...) call from the returned index 'i' until None is
+    returned.  The wrapper is called as func(x, ...), which pylint can't see
+    (it reports no-value-for-parameter)."""
+    @functools.wraps(func)
+    def wrapper(x, *args, **kwargs):
+        """Scans the element list 'x' from start to end."""
+        i = func(x, 0, *args, **kwargs)
+        while i is not None:
+            i = func(x, i, *args, **kwargs)
+        return True
+    return wrapper
+
+
+# acts_on() ------------------------------------------------------------------
+
+# Actions may declare the keys of the elements that they act upon.
+# walk_actions() uses the declaration to avoid calling an action for elements
+# that it would ignore.
+
+def acts_on(*keys, **kwargs):
+    """Returns a decorator that declares the element 'keys' (e.g., 'Para',
+    'Image', 'Cite', ...) that an action acts upon.  If no keys are given then
+    the action is called for every element.
+
+    If the keyword argument newpass=True is given then walk_actions() will
+    not start the action until all previous actions have walked the entire
+    document.  Use this for actions that depend upon what earlier actions
+    did anywhere in the document.
+
+    If the keyword argument local=True is given then walk_actions() may
+    apply the action to top-level elements in parallel processes.  Use this
+    for actions that only read and change the elements they are given.
+
+    An action may also report its status through a 'status' attribute.  This
+    is a function status(fmt, meta) that returns the keys of the elements
+    that the action still acts upon (None for all), or an empty set once the
+    action is finished.  walk_actions() checks it before each top-level
+    element, and stops calling a finished action.
+    """
+
+    newpass = kwargs.pop('newpass', False)
+    local = kwargs.pop('local', False)
+    if kwargs:
+        raise TypeError('Unexpected keyword argument(s): %s' % \
+                        ', '.join(kwargs))
+
+    def decorator(action):
+        """Stores the declaration in the action's attributes."""
+        action.keys = frozenset(keys) if keys else None
+        action.newpass = newpass
+        action.local = local
+        if os.environ.get('XNOS_PROFILE'):
+            action = get_profile().wrap(action)
+        return action
+
+    return decorator
+
+
 #=============================================================================
 # Utility functions
 
 # init() ---------------------------------------------------------------------
 
+# Determining the pandoc version can be expensive.  The cheap sources are
+# tried first: the environment, the caller, and the document.  Failing that,
+# the version is looked up in an on-disk cache keyed by the path and
+# modification time of the pandoc executable.  Only on a cache miss is pandoc
+# itself called.
+
 _PANDOCVERSION = None  # A string giving the pandoc version
 
+def _cache_dir():
+    """Returns the directory used for pandoc-xnos caches."""
+    if 'XNOS_CACHE_DIR' in os.environ:
+        return os.environ['XNOS_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or \
+      os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pandoc-xnos')
+
+def _get_pandoc_command():
+    """Returns the command for the pandoc that called this process."""
+
+    command = None
+
+    # Check the parent process.  Use procfs where available; otherwise load
+    # psutil.
+    try:
+        command = os.readlink('/proc/%d/exe' % os.getppid())
+    except (OSError, AttributeError):
+        try:
+            import psutil
+            if os.name == 'nt':
+                # psutil appears to work differently for windows
+                command = psutil.Process(os.getpid()).parent().parent().exe()
+            else:
+                command = psutil.Process(os.getpid()).parent().exe()
+        except:  # pylint: disable=bare-except
+            pass
+
+    if command and os.path.basename(command).startswith('pandoc'):
+        return command
+
+    # Use whatever pandoc is available and hope for the best
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        command = os.path.join(path, 'pandoc')
+        if os.path.isfile(command) and os.access(command, os.X_OK):
+            return command
+    return 'pandoc'
+
+def _read_version_cache(command):
+    """Returns the cached version for the pandoc 'command', or None."""
+    try:
+        with io.open(os.path.join(_cache_dir(), 'versions.json'),
+                     encoding='utf-8') as f:
+            mtime, version = json.load(f)[command]
+        if mtime == os.path.getmtime(command):
+            return version
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def _write_version_cache(command, version):
+    """Caches the 'version' for the pandoc 'command'."""
+    path = os.path.join(_cache_dir(), 'versions.json')
+    try:
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            cache = {}
+        cache[command] = [os.path.getmtime(command), version]
+        if not os.path.isdir(_cache_dir()):
+            os.makedirs(_cache_dir())
+        # Write to a temporary file and then move it into place so that
+        # concurrent filters never see a partial file
+        tmppath = '%s.%d' % (path, os.getpid())
+        with io.open(tmppath, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        if hasattr(os, 'replace'):  # Python 3.3+
+            os.replace(tmppath, path)  # pylint: disable=no-member
+        else:
+            os.rename(tmppath, path)
+    except (IOError, OSError, TypeError):
+        pass
+
+# AST adapters.  The pandoc json AST changes with the pandoc version:
+#
+#   * 1.16: Link and Image elements get attributes, which puts the link text
+#           at index 1 instead of 0;
+#   * 1.18: Documents get a pandoc-api-version, and references are no longer
+#           broken by the autolink_bare_uris extension;
+#   * 2.10: Table elements are restructured, and their captions hold blocks
+#           rather than inlines.
+#
+# Rather than compare versions for every element, init() chooses an adapter
+# that holds what the actions need to know about the AST.
+
+def _version_tuple(version):
+    """Returns the version string 'version' (e.g., '1.17.2') as a tuple of
+    ints (e.g., (1, 17, 2))."""
+    return tuple(int(n) for n in version.split('.'))
+
+class _ASTAdapter(object):
+    """Describes the pandoc json AST for pandoc 'version' (a tuple)."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, version):
+        self.version = version
+
+        # The index of the link text in the values of Link elements
+        self.linktext = 0 if version < (1, 16) else 1
+
+        # Flags that references may be broken (see repair_refs())
+        self.brokenrefs = version < (1, 18)
+
+        # Dispatch table for the elements holding inline element lists
+        self.inlinelists = dict(_INLINELISTS)
+        if version >= (2, 10):
+            del self.inlinelists['Table']
+
+    def link(self, text, target):
+        """Returns a Link element with the inlines 'text' and 'target'."""
+        if self.linktext:
+            return Link(['', [], []], text, target)
+        return elt('Link', 2)(text, target)
+
+# The adapter used before init() is called
+_AST = _ASTAdapter((1, 18))
+
+
+# DocumentContext ------------------------------------------------------------
+
+# The state kept while processing a document (the pandoc version, whether or
+# not cleveref TeX is needed, and the section numbers) is held in a
+# DocumentContext.  Documents with contexts of their own may be processed at
+# the same time (e.g., in threads).  The default context keeps the state in
+# the module globals, as before, so that filters that use the globals keep
+# working.
+
+class DocumentContext(object):
+    """The state kept while processing a document.
+
+    Pass a DocumentContext as the 'context' to init(), walk_actions(),
+    filter_stream() and the factory functions.  Use its join_strings and
+    repair_refs actions in place of the module's.  Where no context is
+    given the default one is used, which keeps the state in the module
+    globals (_PANDOCVERSION, _CLEVEREFTEX, MAXLEVEL, SEC and _METADATA)."""
+
+    def __init__(self):
+        self.pandocversion = None        # A string giving the pandoc version
+        self.ast = _ASTAdapter((1, 18))  # Describes the AST (see init())
+        self.clevereftex = False  # Flags that cleveref TeX is needed
+        self.maxlevel = 1         # The maximum level header to track
+        self.sec = [0]            # The section numbers
+        self.metadata = None      # The Metadata (see get_metadata())
+
+    def __getattr__(self, name):
+        # The actions are made for the context when they are first used
+        if name in ['join_strings', 'repair_refs']:
+            action = globals()['_%s_factory' % name](self)
+            setattr(self, name, action)
+            return action
+        raise AttributeError(name)
+
+def _global_property(name):
+    """Returns a property for the module global 'name'."""
+    def fget(self):  # pylint: disable=unused-argument
+        """Gets the global."""
+        return globals()[name]
+    def fset(self, value):  # pylint: disable=unused-argument
+        """Sets the global."""
+        globals()[name] = value
+    return property(fget, fset)
+
+class _DefaultContext(DocumentContext):
+    """The default context, which keeps the state in the module globals."""
+
+    # pylint: disable=super-init-not-called
+
+    pandocversion = _global_property('_PANDOCVERSION')
+    ast = _global_property('_AST')
+    clevereftex = _global_property('_CLEVEREFTEX')
+    maxlevel = _global_property('MAXLEVEL')
+    sec = _global_property('SEC')
+    metadata = _global_property('_METADATA')
+
+    def __init__(self):
+        pass
+
+_DEFAULT_CONTEXT = _DefaultContext()
+
+def _set_version(pandocversion, context):
+    """Sets the pandoc version and chooses the AST adapter for the
+    'context'.  Returns the version."""
+    context.pandocversion = pandocversion
+    context.ast = _ASTAdapter(_version_tuple(pandocversion))
+    return pandocversion
+
+# The pandoc versions that introduced the pandoc-api-versions
+_APIVERSIONS = [((1, 23), '3.0'), ((1, 21), '2.10'), ((1, 20), '2.8'),
+                ((1, 17), '1.18')]
+
 # pylint: disable=too-many-branches
-def init(pandocversion=None, doc=None):
+def init(pandocversion=None, doc=None, context=None):
     """Sets or determines the pandoc version.  This must be called.
 
     The pandoc version is needed for multi-version support.
     See: https://github.com/jgm/pandoc/issues/2640
 
+    Pandoc 1.x, 2.x and 3.x are supported.  The 'pandocversion' may be given
+    as a string (e.g., '2.19.2') or tuple (e.g., (2, 19, 2)).  For documents
+    with a pandoc-api-version, the earliest pandoc version giving that api
+    version is assumed.
+
+    The version is stored in the DocumentContext 'context', or the default
+    context if none is given.
+
     Returns the pandoc version."""
 
     # This requires some care because we can't be sure that a call to 'pandoc'
@@ -148,62 +556,63 @@ def init(pandocversion=None, doc=None):
     # checking the parent process first, and only make a call to 'pandoc' as
     # a last resort.
 
-    global _PANDOCVERSION  # pylint: disable=global-statement
+    if context is None:
+        context = _DEFAULT_CONTEXT
 
-    pattern = re.compile(r'^1\.[0-9]+(?:\.[0-9]+)?(?:\.[0-9]+)?$')
+    pattern = re.compile(r'^[1-3]\.[0-9]+(?:\.[0-9]+)?(?:\.[0-9]+)?$')
 
     if 'PANDOC_VERSION' in os.environ:  # Available for pandoc >= 1.19.1
         pandocversion = str(os.environ['PANDOC_VERSION'])
 
+    if isinstance(pandocversion, (tuple, list)):
+        pandocversion = '.'.join(str(n) for n in pandocversion)
+
     if not pandocversion is None:
         # Test the result and if it is OK then store it in _PANDOCVERSION
         if pattern.match(pandocversion):
-            _PANDOCVERSION = pandocversion
-            return _PANDOCVERSION
+            return _set_version(pandocversion, context)
         else:
             msg = 'Cannot understand pandocversion=%s'%pandocversion
             raise RuntimeError(msg)
 
     if not doc is None:
         if 'pandoc-api-version' in doc:
-            # This could be either 1.18 or 1.19; there is no way to
-            # distinguish them (but there isn't a use case in pandoc-fignos
-            # and friends where it matters)
-            _PANDOCVERSION = '1.18'
-            return _PANDOCVERSION
-
-    # Get the command
-    try:  # Get the path for the parent process
-        if os.name == 'nt':
-            # psutil appears to work differently for windows
-            command = psutil.Process(os.getpid()).parent().parent().exe()
-        else:
-            command = psutil.Process(os.getpid()).parent().exe()
-        if not os.path.basename(command).startswith('pandoc'):
-            raise RuntimeError('pandoc not found')
-    except:  # pylint: disable=bare-except
-        # Call whatever pandoc is available and hope for the best
-        command = 'pandoc'
-
-    # Make the call
-    try:
-        # Get the version number and confirm it conforms to expectations
-        output = subprocess.check_output([command, '-v'])
-        line = output.decode('utf-8').split('\n')[0]
-        pandocversion = line.split(' ')[-1].strip()
-    except: # pylint: disable=bare-except
-        pandocversion = ''
+            # The pandoc versions giving an api version can't be
+            # distinguished (but there isn't a use case in pandoc-fignos and
+            # friends where it matters)
+            apiversion = tuple(doc['pandoc-api-version'])
+            for minapiversion, pandocversion in _APIVERSIONS:
+                if apiversion >= minapiversion:
+                    return _set_version(pandocversion, context)
+
+    # Get the command and check the cache
+    command = _get_pandoc_command()
+    pandocversion = _read_version_cache(command)
+
+    if pandocversion is None:
+        # Make the call
+        try:
+            import subprocess
+            # Get the version number and confirm it conforms to expectations
+            output = subprocess.check_output([command, '-v'])
+            line = output.decode('utf-8').split('\n')[0]
+            pandocversion = line.split(' ')[-1].strip()
+        except: # pylint: disable=bare-except
+            pandocversion = ''
+        if pattern.match(pandocversion):
+            _write_version_cache(command, pandocversion)
 
     # Test the result and if it is OK then store it in _PANDOCVERSION
     if pattern.match(pandocversion):
-        _PANDOCVERSION = pandocversion
+        _set_version(pandocversion, context)
 
-    if _PANDOCVERSION is None:
+    if context.pandocversion is None:
+        import textwrap
         msg = """Cannot determine pandoc version.  Please file an issue at
               https://github.com/tomduck/pandocfiltering/issues"""
         raise RuntimeError(textwrap.dedent(msg))
 
-    return _PANDOCVERSION
+    return context.pandocversion
 
 
 # get_meta() -----------------------------------------------------------------
@@ -228,33 +637,951 @@ def get_meta(meta, name):
                            name)
 
 
+# get_metadata() -------------------------------------------------------------
+
+# Actions check xnos-* metadata variables for every element they act upon.
+# A Metadata object decodes them once per document instead.  Use
+# get_metadata() to get the object for a document's 'meta' dict.  The object
+# is kept in the document's DocumentContext.
+
+class Metadata(object):
+    """Decoded variables from a document's metadata.
+
+    The xnos-* variables are decoded when the object is made.  Others are
+    decoded when first used.  Values are the same as given by get_meta(),
+    which also determines the errors raised."""
+
+    def __init__(self, meta):
+        self.meta = meta
+        self._values = {}  # Decoded values
+
+        for name in meta:
+            if name.startswith('xnos-') and meta[name]['t'] in \
+              ['MetaString', 'MetaBool', 'MetaInlines', 'MetaList']:
+                self._values[name] = get_meta(meta, name)
+
+    def __contains__(self, name):
+        return name in self.meta
+
+    def __getitem__(self, name):
+        if not name in self._values:
+            self._values[name] = get_meta(self.meta, name)
+        return self._values[name]
+
+    def isset(self, name):
+        """True if variable 'name' is in the metadata with non-empty
+        content; False otherwise."""
+        return name in self.meta and bool(self.meta[name]['c'])
+
+_METADATA = None  # The Metadata for the default DocumentContext
+
+def get_metadata(meta, context=None):
+    """Returns the Metadata object for the document's 'meta' dict.  The
+    object is kept in the DocumentContext 'context', if not the default
+    one."""
+    if context is None:
+        context = _DEFAULT_CONTEXT
+    metadata = context.metadata
+    if metadata is None or metadata.meta is not meta:
+        metadata = Metadata(meta)
+        context.metadata = metadata
+    return metadata
+
+
+# load_doc() and dump_doc() --------------------------------------------------
+
+# Most of a filter's time on a large document is spent parsing and
+# serializing json.  load_doc() uses the fastest json decoder that is
+# installed, and falls back to the json module.  Set XNOS_JSON=json to
+# always use the json module.  There is no fast encoder that gives the same
+# output as json.dumps(), and so dump_doc() always uses json.  Both read and
+# write binary streams, which skips the UTF-8 text wrappers.
+
+_FASTJSON = ['orjson']  # Fast json modules, in order of preference
+_LOADS = None           # The json decoding function; chosen on first use
+
+def _get_loads():
+    """Returns the fastest available json decoding function."""
+    global _LOADS  # pylint: disable=global-statement
+    if _LOADS is None:
+        _LOADS = json.loads
+        if os.environ.get('XNOS_JSON') != 'json':
+            for name in _FASTJSON:
+                try:
+                    _LOADS = __import__(name).loads
+                    break
+                except ImportError:
+                    pass
+    return _LOADS
+
+def _loads(data):
+    """Decodes the json 'data', which is either bytes or text."""
+    loads = _get_loads()
+    if loads is not json.loads:
+        # Fast decoders may refuse json that the json module accepts (e.g.,
+        # lone surrogates or very large integers)
+        try:
+            return loads(data)
+        except ValueError:
+            pass
+    if isinstance(data, bytes) and sys.version_info > (3,):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+def load_doc(stream=None):
+    """Reads and returns the pandoc json document from 'stream', which
+    defaults to the binary STDIN."""
+    if stream is None:
+        stream = sys.stdin.buffer if sys.version_info > (3,) else sys.stdin
+    if _PROFILE is None:
+        return _loads(stream.read())
+    start = _CLOCK()
+    doc = _loads(stream.read())
+    _PROFILE.add('load_doc', _CLOCK() - start)
+    return doc
+
+def dump_doc(doc, stream=None):
+    """Writes the pandoc json 'doc' to 'stream', which defaults to the binary
+    STDOUT.  The output is the same as given by json.dump()."""
+    if stream is None:
+        # Anything already written to STDOUT must come first
+        if isinstance(STDOUT, _LazyStream) and \
+          STDOUT._stream is not None:  # pylint: disable=protected-access
+            STDOUT.flush()
+        stream = sys.stdout.buffer if sys.version_info > (3,) else sys.stdout
+    start = _CLOCK()
+    data = json.dumps(doc)
+    if not isinstance(stream, io.TextIOBase) and \
+      not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    stream.write(data)
+    stream.flush()
+    if _PROFILE is not None:
+        _PROFILE.add('dump_doc', _CLOCK() - start)
+
+
+# Profile --------------------------------------------------------------------
+
+# Profiling is opt-in.  Set the XNOS_PROFILE environment variable, or the
+# xnos-profile metadata variable, to 1 (or True) to have a summary written to
+# STDERR when the filter exits, or to a filename to have the summary appended
+# to it as a line of json.  The json lines from many filter runs may be
+# aggregated.
+#
+# With XNOS_PROFILE set, actions are profiled from when they are made by
+# acts_on(), and extract_attrs() and the json input/output are profiled too.
+# With xnos-profile set, actions are profiled from when walk_actions() is
+# first given the document's metadata.  Actions applied in parallel processes
+# (see walk_actions()) are not profiled.
+
+_CLOCK = getattr(time, 'perf_counter', time.time)
+
+class Profile(object):
+    """Records the calls to functions and actions.
+
+    For each one the number of 'calls', the number of calls that 'replaced'
+    the element acted upon (i.e., returned something other than None), the
+    number of times that helpers restarted a scan of an element list from
+    the beginning during the calls (see _repeat()), and the cumulative time in 'seconds' are recorded in the
+    'stats' dict under the function's name.
+
+    'output' is the filename for the summary, or None for STDERR.  The
+    stats are for the whole process; the function being called is tracked
+    for each thread."""
+
+    def __init__(self, output=None):
+        import threading
+        self.output = output
+        self.stats = collections.OrderedDict()
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        """The stats for the function being called in this thread."""
+        return getattr(self._local, 'current', None)
+
+    @current.setter
+    def current(self, stats):
+        self._local.current = stats
+
+    def get_stats(self, name):
+        """Returns the stats dict for 'name'."""
+        if not name in self.stats:
+            self.stats[name] = {'calls':0, 'replaced':0, 'restarts':0,
+                                'seconds':0.}
+        return self.stats[name]
+
+    def wrap(self, func):
+        """Returns a wrapper for 'func' that records its calls."""
+
+        if getattr(func, 'profiled', False):
+            return func
+
+        name = getattr(func, '__name__', repr(func))
+        if getattr(func, '__module__', __name__) != __name__:
+            name = '%s.%s' % (func.__module__, name)
+        stats = self.get_stats(name)
+
+        @functools.wraps(func, [attr for attr in functools.WRAPPER_ASSIGNMENTS
+                                if hasattr(func, attr)])
+        def wrapper(*args, **kwargs):
+            """Records the call."""
+            current, self.current = self.current, stats
+            start = _CLOCK()
+            try:
+                ret = func(*args, **kwargs)
+            finally:
+                stats['seconds'] += _CLOCK() - start
+                self.current = current
+            stats['calls'] += 1
+            if ret is not None:
+                stats['replaced'] += 1
+            return ret
+
+        wrapper.profiled = True
+        return wrapper
+
+    def restart(self):
+        """Records a restart of an element list scan from the
+        beginning."""
+        if self.current is not None:
+            self.current['restarts'] += 1
+
+    def add(self, name, seconds):
+        """Records a call to 'name' that took 'seconds'."""
+        stats = self.get_stats(name)
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+
+    def report(self):
+        """Writes the summary."""
+        if self.output is None:
+            STDERR.write('%s: profile\n' % os.path.basename(sys.argv[0]))
+            STDERR.write('  %-32s %8s %8s %8s %10s\n' % \
+                         ('name', 'calls', 'replaced', 'restarts', 'seconds'))
+            for name, stats in self.stats.items():
+                STDERR.write('  %-32s %8d %8d %8d %10.4f\n' % \
+                             (name, stats['calls'], stats['replaced'],
+                              stats['restarts'], stats['seconds']))
+            STDERR.flush()
+        else:
+            line = json.dumps({'argv':sys.argv, 'pid':os.getpid(),
+                               'time':time.time(), 'stats':self.stats})
+            try:
+                with io.open(self.output, 'ab') as f:
+                    f.write((line + '\n').encode('utf-8'))
+            except (IOError, OSError) as e:
+                STDERR.write('Cannot write profile: %s\n' % e)
+
+_PROFILE = None  # The Profile, if profiling is enabled
+
+def get_profile(output=None):
+    """Enables profiling and returns the Profile.  The 'output' is 1, True
+    or 'stderr' to write the summary to STDERR on exit, or else a filename.
+    It defaults to the XNOS_PROFILE environment variable."""
+    global _PROFILE  # pylint: disable=global-statement
+    if _PROFILE is None:
+        if output is None:
+            output = os.environ.get('XNOS_PROFILE')
+        if output is True or str(output).lower() in ['1', 'true', 'stderr']:
+            output = None
+        _PROFILE = Profile(output)
+        import atexit
+        atexit.register(_PROFILE.report)
+    return _PROFILE
+
+
+# walk_actions() -------------------------------------------------------------
+
+# Each pandocfilters.walk() call copies the entire document, and calls the
+# action for every element in it.  Filters typically apply a series of
+# actions, one walk() at a time.  walk_actions() instead takes each top-level
+# element through the whole series before moving on to the next one, edits
+# the document in place, and only calls actions for the elements they act
+# upon.  The result is the same as for the series of walk() calls so long as
+# no action depends upon what an earlier action did to later top-level
+# elements.  Such actions must be declared with newpass=True (see acts_on()).
+
+def _walk(x, action, keys, fmt, meta):
+    """Walks 'x' in place, applying 'action' to elements with 'keys'.  If
+    'keys' is None then the action is applied to all elements."""
+    if isinstance(x, list):
+        array = None  # Replacement for x; only made if needed
+        for n, item in enumerate(x):
+            if isinstance(item, dict) and 't' in item and \
+              (keys is None or item['t'] in keys):
+                ret = action(item['t'], item['c'] if 'c' in item else None,
+                             fmt, meta)
+                if ret is not None:
+                    if array is None:
+                        array = x[:n]
+                    for el in ret if isinstance(ret, list) else [ret]:
+                        _walk(el, action, keys, fmt, meta)
+                        array.append(el)
+                    continue
+            if isinstance(item, dict):  # Walk the values here to save a call
+                for v in item.values():
+                    if isinstance(v, (list, dict)):
+                        _walk(v, action, keys, fmt, meta)
+            elif isinstance(item, list):
+                _walk(item, action, keys, fmt, meta)
+            if array is not None:
+                array.append(item)
+        if array is not None:
+            x[:] = array
+    elif isinstance(x, dict):
+        for v in x.values():
+            if isinstance(v, (list, dict)):
+                _walk(v, action, keys, fmt, meta)
+
+def walk_actions(x, actions, fmt, meta, processes=None, cache=None,
+                 context=None):
+    """Walks the element tree 'x', applying the list of 'actions' in order.
+
+    The result is the same as given by
+
+        functools.reduce(lambda x, action: walk(x, action, fmt, meta),
+                         actions, x)
+
+    except that 'x' is modified in place.  If 'x' is a list then the
+    actions are applied to one item at a time, and so the list is only
+    walked once for each group of actions that starts with a newpass=True
+    action.  Actions declared using acts_on() are only called for the
+    elements they act upon.
+
+    If 'processes' is greater than 1 then runs of local=True actions (see
+    acts_on()) are applied to the items of a large list 'x' using that many
+    processes.  The other actions are applied in this process, and so should
+    do any numbering that the local actions depend upon.  If 'processes' is
+    None then it is taken from the XNOS_PROCESSES environment variable,
+    and otherwise is 1.  Parallel processing needs the 'fork' start method,
+    and is skipped where it isn't available.
+
+    If a BlockCache is given as the 'cache' then the results of runs of
+    local actions on the items of a list 'x' are taken from it where
+    possible, and are otherwise stored in it.
+
+    The 'context' is the DocumentContext used by the actions, if not the
+    default one.
+
+    Returns 'x'."""
+
+    if processes is None:
+        processes = _get_processes()
+    if context is None:
+        context = _DEFAULT_CONTEXT
+
+    # Profile the actions if asked (see Profile)
+    if _PROFILE is None and meta:
+        metadata = get_metadata(meta, context)
+        if metadata.isset('xnos-profile'):
+            get_profile(metadata['xnos-profile'])
+    if _PROFILE is not None:
+        actions = [_PROFILE.wrap(action) for action in actions]
+
+    for group in _group_actions(actions):
+        if isinstance(x, list) and (processes > 1 or cache is not None):
+            for local, run in _split_group(group):
+                if local:
+                    _walk_local(x, run, fmt, meta, processes, cache,
+                                context)
+                else:
+                    _walk_list(x, run, fmt, meta)
+        elif isinstance(x, list):
+            _walk_list(x, group, fmt, meta)
+        else:
+            _walk_group(x, group, fmt, meta)
+
+    if cache is not None:
+        cache.tidy()
+
+    return x
+
+def _get_processes():
+    """Returns the number of processes given by the XNOS_PROCESSES
+    environment variable, or 1 if it isn't set or can't be understood."""
+    value = os.environ.get('XNOS_PROCESSES', '1')
+    try:
+        return int(value)
+    except ValueError:
+        STDERR.write('%s: Cannot understand XNOS_PROCESSES=%s; using 1\n' % \
+                     (os.path.basename(sys.argv[0]), value))
+        return 1
+
+def _group_actions(actions):
+    """Breaks the list of 'actions' into groups that can be applied item by
+    item.  Each group is a list of (action, keys) tuples."""
+    groups = []
+    for action in actions:
+        if not groups or getattr(action, 'newpass', False):
+            groups.append([])
+        groups[-1].append((action, getattr(action, 'keys', None)))
+    return groups
+
+def _walk_group(x, group, fmt, meta):
+    """Walks 'x' in place once for each action in the 'group'."""
+    for action, keys in group:
+        _walk(x, action, keys, fmt, meta)
+
+def _update_group(group, fmt, meta):
+    """Returns the 'group' with the keys of actions that report their status
+    updated, and without the finished actions (see acts_on())."""
+    updated = []
+    for action, keys in group:
+        if hasattr(action, 'status'):
+            keys = action.status(fmt, meta)
+            if keys is not None and not keys:  # The action is finished
+                continue
+        updated.append((action, keys))
+    return updated
+
+def _walk_list(x, group, fmt, meta):
+    """Takes each item in the list 'x' through the 'group' of actions in
+    turn.  The list is changed in place."""
+    status = any(hasattr(action, 'status') for action, _ in group)
+    array = []
+    for n, item in enumerate(x):
+        if status:
+            group = _update_group(group, fmt, meta)
+            if not group:  # Every action is finished
+                array.extend(x[n:])
+                break
+        items = [item]
+        _walk_group(items, group, fmt, meta)
+        array.extend(items)
+    x[:] = array
+
+
+# Local actions don't depend upon what other actions do to other top-level
+# elements (see acts_on()), and so a group's runs of local and non-local
+# actions may be applied one after the other.  The local runs are applied to
+# each top-level element on its own.  That allows them to be applied in
+# forked processes, which inherit the elements, actions and state from this
+# one, and for the results to be cached (see BlockCache).  Each result is
+# returned along with any state that must be passed back to the context.
+
+_MINSHARD = 32   # The minimum number of items in a shard
+_SHARED = None   # (x, run, fmt, meta, context) in a forked process
+
+def _split_group(group):
+    """Splits the 'group' of actions into runs of local and non-local
+    actions.  Returns a list of (local, run) tuples."""
+    runs = []
+    for action, keys in group:
+        local = getattr(action, 'local', False)
+        if not runs or runs[-1][0] != local:
+            runs.append((local, []))
+        runs[-1][1].append((action, keys))
+    return runs
+
+def _walk_items(x, run, fmt, meta, context):
+    """Walks each item in the list 'x' with the 'run' of local actions.
+    Returns a list of (items, clevereftex) results giving the items that
+    each item became, and if it flagged in the 'context' that cleveref TeX
+    is needed."""
+
+    saved = context.clevereftex
+    results = []
+    try:
+        for item in x:
+            context.clevereftex = False
+            items = [item]
+            _walk_group(items, run, fmt, meta)
+            results.append((items, context.clevereftex))
+    finally:
+        context.clevereftex = saved
+    return results
+
+def _init_shard(*shared):
+    """Stores what is 'shared' with a forked process."""
+    global _SHARED  # pylint: disable=global-statement
+    _SHARED = shared
+
+def _walk_shard(start, stop):
+    """Walks items start:stop of the shared list in a forked process.
+    Returns the results."""
+    x, run, fmt, meta, context = _SHARED  # pylint: disable=unpacking-non-sequence
+    return _walk_items(x[start:stop], run, fmt, meta, context)
+
+def _walk_parallel(x, run, fmt, meta, processes, context):
+    """Walks the list 'x' with the 'run' of local actions using a pool of
+    forked processes.  Returns the results, or None if this couldn't be
+    done."""
+
+    size = max(_MINSHARD, -(-len(x) // (processes*4)))  # Items per shard
+    if processes < 2 or len(x) <= size:
+        return None
+
+    # Nothing is shared through this process's globals, and so other threads
+    # may walk lists in parallel too
+    executor = _fork_executor(processes, _init_shard,
+                              (x, run, fmt, meta, context))
+    if executor is None:
+        return None
+    with executor:
+        futures = [executor.submit(_walk_shard, i, i+size)
+                   for i in range(0, len(x), size)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+
+    return results
+
+def _fork_executor(processes, initializer, initargs):
+    """Returns a ProcessPoolExecutor with 'processes' forked processes that
+    call initializer(*initargs) when they start, or None if processes can't
+    be forked.  The forked processes inherit the 'initargs' without them
+    being pickled."""
+    import multiprocessing
+    if not 'fork' in multiprocessing.get_all_start_methods():
+        return None
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:  # Python 2
+        return None
+    return ProcessPoolExecutor(processes,
+                               mp_context=multiprocessing.get_context('fork'),
+                               initializer=initializer, initargs=initargs)
+
+def _walk_local(x, run, fmt, meta, processes, cache, context):
+    """Walks the list 'x' in place with the 'run' of local actions.  Items
+    are taken from the 'cache' if possible, and otherwise are walked in
+    parallel if possible."""
+
+    # Get what we can from the cache
+    if cache is not None:
+        name, keys = cache.get_keys(x, run, fmt, meta, context.pandocversion)
+        results = cache.get(name, keys)
+    else:
+        results = [None]*len(x)
+
+    # Walk the rest
+    missing = [i for i, result in enumerate(results) if result is None]
+    todo = [x[i] for i in missing]
+    done = _walk_parallel(todo, run, fmt, meta, processes, context) or \
+      _walk_items(todo, run, fmt, meta, context)
+    for i, result in zip(missing, done):
+        results[i] = result
+    if cache is not None and missing:
+        cache.put(name, keys, results)
+
+    x[:] = [item for items, _ in results for item in items]
+    context.clevereftex = context.clevereftex or \
+      any(flag for _, flag in results)
+
+
+# BlockCache -----------------------------------------------------------------
+
+# Documents are often rebuilt after small edits.  A BlockCache stores the
+# results of local actions on top-level elements so that only the changed
+# elements need to be walked again.  The results for a run of local actions
+# are kept together in one file, which is read once and written once (and
+# only if something changed).  The file is named by a hash of everything
+# the actions depend upon besides the elements: the format, the metadata
+# (all of it, to be safe), the pandoc version, the names of the actions and
+# their 'cachekey' attributes (e.g., the labels known to process_refs()),
+# and the cache's own context.  Any change to these (e.g., a shift in
+# numbering) gives a new file, and the old ones are eventually evicted.
+# Within a file the results are keyed by a hash of each element's json.
+# Keys aren't sorted for that: pandoc writes them in a fixed order, and
+# another order only costs a miss.
+
+class BlockCache(object):
+    """An on-disk cache of top-level elements processed by local actions.
+    Pass it to walk_actions() as the 'cache'.
+
+    Local actions may have a 'cachekey' attribute, which is a function that
+    returns json-serializable data that their results depend upon besides
+    the elements, format, metadata and pandoc version.  Anything else may
+    be given in the 'context' argument (e.g., the references dict).  Each
+    file holds the results for the last list walked with a run of actions,
+    and so different documents should be given different contexts (e.g.,
+    their filenames).
+
+    Files are stored in the 'blocks' subdirectory of XNOS_CACHE_DIR (or
+    the user cache directory), unless a 'path' is given.  The least recently
+    used files are evicted once the cache is bigger than 'maxsize'
+    bytes.  Since that means looking at every file, it is only checked
+    after an eighth of 'maxsize' bytes have been written (see tidy())."""
+
+    def __init__(self, context=None, maxsize=2**27, path=None):
+        self.context = context
+        self.maxsize = maxsize
+        self.path = path or os.path.join(_cache_dir(), 'blocks')
+        self.hits = 0     # The number of items found in the cache
+        self.misses = 0   # The number of items not found in the cache
+        self.written = 0  # The number of bytes written but not yet tallied
+
+    def get_keys(self, x, run, fmt, meta, pandocversion):
+        """Returns the name of the file for the 'run' of (action, keys)
+        tuples, and the keys for the items in the list 'x'."""
+        import hashlib
+        data = [self.context, fmt, meta, pandocversion]
+        for action, _ in run:
+            data.append([getattr(action, '__module__', None),
+                         getattr(action, '__name__', None),
+                         action.cachekey() if hasattr(action, 'cachekey') \
+                         else None])
+        name = hashlib.sha1(json.dumps(data, sort_keys=True,
+                                       default=repr).encode('utf-8'))
+        dumps = json.JSONEncoder(check_circular=False).encode
+        keys = [hashlib.sha1(dumps(item).encode('utf-8')).hexdigest()
+                for item in x]
+        return name.hexdigest(), keys
+
+    def _get_filename(self, name):
+        """Returns the filename for the file 'name'."""
+        return os.path.join(self.path, name + '.json')
+
+    def get(self, name, keys):
+        """Returns the (items, clevereftex) results for the 'keys' in the
+        file 'name', with None for those not found."""
+        filename = self._get_filename(name)
+        try:
+            with io.open(filename, 'rb') as f:
+                entries = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            entries = {}
+        results = [entries.get(key) for key in keys]
+        misses = results.count(None)
+        self.hits += len(keys) - misses
+        self.misses += misses
+        if entries and not misses:  # Marks the file as recently used
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+        return results
+
+    def put(self, name, keys, results):
+        """Stores the (items, clevereftex) 'results' for the 'keys' in the
+        file 'name', replacing what was there."""
+        filename = self._get_filename(name)
+        tmpname = '%s.%d' % (filename, os.getpid())
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            data = json.dumps(dict(zip(keys, results))).encode('utf-8')
+            with io.open(tmpname, 'wb') as f:
+                f.write(data)
+            os.rename(tmpname, filename)
+            self.written += len(data)
+        except (IOError, OSError):
+            pass
+
+    def tidy(self):
+        """Adds the bytes written by this cache to the tally kept in the
+        cache directory, and prunes the cache once the tally exceeds an
+        eighth of 'maxsize'.  Nothing is done if nothing was written."""
+        if not self.written:
+            return
+        filename = os.path.join(self.path, 'written')
+        try:
+            with io.open(filename, 'rb') as f:
+                tally = int(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            tally = 0
+        tally += self.written
+        self.written = 0
+        if tally > self.maxsize // 8:
+            self.prune()
+            return
+        try:
+            with io.open(filename, 'wb') as f:
+                f.write(str(tally).encode('utf-8'))
+        except (IOError, OSError):
+            pass
+
+    def prune(self):
+        """Evicts the least recently used entries until the cache is no
+        bigger than 'maxsize' bytes, and resets the tally of bytes
+        written."""
+        try:
+            os.remove(os.path.join(self.path, 'written'))
+        except OSError:
+            pass
+        entries = []  # (mtime, size, filename) tuples
+        total = 0
+        try:
+            filenames = os.listdir(self.path)
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+            filename = os.path.join(self.path, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        entries.sort()
+        for _, size, filename in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+
+# filter_stream() ------------------------------------------------------------
+
+# A filter normally reads the whole json document into memory, and then
+# writes the whole altered document out again.  For a book-length document
+# the json text and the element tree are together several times the size of
+# the input.  filter_stream() instead parses the document's blocks one at a
+# time, and writes each out as soon as the actions are done with it.  Only
+# the first group of actions (see walk_actions()) can work this way.  Later
+# groups depend on what was found in the whole document (e.g., numbering and
+# cleveref TeX insertion), and so the blocks are kept until they are done.
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class _JSONReader(object):
+    """Reads json values one at a time from a stream."""
+
+    def __init__(self, stream, chunksize=65536):
+        self.stream = stream
+        self.chunksize = chunksize
+        self.buf = ''    # The unparsed text
+        self.pos = 0     # The parse position in buf
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=0):
+        """Reads at least 'size' more characters into the buffer.  Returns
+        False at the end of the stream."""
+        chunk = None if self.eof else \
+          self.stream.read(max(size, self.chunksize))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it.
+        An empty string is returned at the end of the stream."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Consumes and returns the next character, which must be one of
+        'chars'."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of %s in json stream.' % chars)
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Reads and returns the next json value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value that ends the buffer (e.g., a number) may continue
+                # in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Read at least as much again to avoid reparsing too often
+            self._fill(len(self.buf) - self.pos)
+
+def _get_doc_meta(doc):
+    """Returns the metadata from a (possibly partial) pandoc json 'doc'.
+    None is returned if it hasn't been read yet."""
+    if isinstance(doc, dict):
+        return doc['meta'] if 'meta' in doc else None
+    else:
+        return doc[0]['unMeta'] if doc else None
+
+def filter_stream(get_actions, fmt, instream=None, outstream=None,
+                  context=None):
+    """Reads a pandoc json document from 'instream', applies actions to it,
+    and writes the result to 'outstream'.  The streams default to STDIN and
+    STDOUT.
+
+    get_actions(doc) is called once the document's metadata has been read.
+    The 'doc' argument holds what has been read of the document, which
+    normally is everything except for its blocks.  It must return the list
+    of actions, which are applied to the blocks for output format 'fmt' as
+    they would be by walk_actions().  The 'context' is passed on to
+    walk_actions().  The output is the same as given by json.dumps()."""
+
+    reader = _JSONReader(STDIN if instream is None else instream)
+    outstream = STDOUT if outstream is None else outstream
+    write = outstream.write
+
+    opener = reader.expect('{[')
+    closer = '}' if opener == '{' else ']'
+    doc = {} if opener == '{' else []
+    pieces = []       # Serialized members of doc that aren't yet written
+    streamed = False  # Flags that the blocks were streamed
+    n = 0             # The number of members read
+
+    while reader.peek() != closer:
+        if n:
+            reader.expect(',')
+        n += 1
+
+        # Read the next member's key
+        if opener == '{':
+            key = reader.value()
+            reader.expect(':')
+            prefix = json.dumps(key) + ': '
+        else:
+            key, prefix = len(doc), ''
+
+        if key in ['blocks', 1] and not streamed and \
+          _get_doc_meta(doc) is not None:
+
+            # Write everything up to the blocks
+            meta = _get_doc_meta(doc)
+            groups = _group_actions(get_actions(doc)) or [[]]
+            group = groups[0]
+            status = any(hasattr(action, 'status') for action, _ in group)
+            write(opener + ''.join(piece + ', ' for piece in pieces) + \
+                  prefix + '[')
+            pieces = []
+
+            blocks = []   # Blocks kept for the later groups of actions
+            sep = ''      # Separator for the next block written
+            m = 0         # The number of blocks read
+            reader.expect('[')
+            while reader.peek() != ']':
+                if m:
+                    reader.expect(',')
+                m += 1
+                items = [reader.value()]
+                if status:
+                    group = _update_group(group, fmt, meta)
+                _walk_group(items, group, fmt, meta)
+                if len(groups) > 1:
+                    blocks.extend(items)
+                    continue
+                for item in items:
+                    write(sep + json.dumps(item))
+                    sep = ', '
+            reader.expect(']')
+
+            if blocks:
+                walk_actions(blocks, [action for group in groups[1:]
+                                      for action, _ in group], fmt, meta,
+                             context=context)
+                write(', '.join(json.dumps(block) for block in blocks))
+            write(']')
+            streamed = True
+
+        else:
+            value = reader.value()
+            if opener == '{':
+                doc[key] = value
+            else:
+                doc.append(value)
+            if streamed:
+                write(', ' + prefix + json.dumps(value))
+            else:
+                pieces.append(prefix + json.dumps(value))
+
+    reader.expect(closer)
+
+    if streamed:
+        write(closer)
+    else:
+        # Fall back to filtering the whole document
+        blocks = doc['blocks'] if opener == '{' else doc[1]
+        walk_actions(blocks, get_actions(doc), fmt, _get_doc_meta(doc),
+                     context=context)
+        write(json.dumps(doc))
+
+    if hasattr(outstream, 'flush'):
+        outstream.flush()
+
+
 # elt() ----------------------------------------------------------------------
 
+# pandocfilters.elt() makes a new closure each time it is called, and the
+# elements it makes may hold tuples.  Here the constructors are made once
+# and kept in a table, and they make the element dicts directly.
+
+# The number of arguments for each element type.  Link and Image have one
+# less before pandoc 1.16, and Table has one more from pandoc 2.10 (see
+# _ASTAdapter).
+_NUMARGS = {
+    # Blocks
+    'Plain':1, 'Para':1, 'LineBlock':1, 'CodeBlock':2, 'RawBlock':2,
+    'BlockQuote':1, 'OrderedList':2, 'BulletList':1, 'DefinitionList':1,
+    'Header':3, 'HorizontalRule':0, 'Table':5, 'Figure':3, 'Div':2, 'Null':0,
+    # Inlines
+    'Str':1, 'Emph':1, 'Underline':1, 'Strong':1, 'Strikeout':1,
+    'Superscript':1, 'Subscript':1, 'SmallCaps':1, 'Quoted':2, 'Cite':2,
+    'Code':2, 'Space':0, 'SoftBreak':0, 'LineBreak':0, 'Math':2,
+    'RawInline':2, 'Link':3, 'Image':3, 'Note':1, 'Span':2
+}
+
+def _make_element_constructor(eltType, numargs):  # pylint: disable=invalid-name
+    """Returns Element(*value) to create pandoc json elements of type
+    'eltType'."""
+    def Element(*value):  # pylint: disable=invalid-name
+        """Creates an element."""
+        if len(value) != numargs:
+            raise ValueError('%s expects %d arguments, but given %d' %
+                             (eltType, numargs, len(value)))
+        if numargs == 0:
+            return {'t':eltType, 'c':[]}
+        elif numargs == 1:
+            return {'t':eltType, 'c':value[0]}
+        return {'t':eltType, 'c':list(value)}
+    return Element
+
+# The element constructors keyed by type and number of arguments
+_ELTS = dict(((eltType, numargs), _make_element_constructor(eltType, numargs))
+             for eltType, numargs in list(_NUMARGS.items()) + \
+             [('Link', 2), ('Image', 2), ('Table', 6)])
+
 def elt(eltType, numargs):  # pylint: disable=invalid-name
     """Returns Element(*value) to create pandoc json elements.
 
     This should be used in place of pandocfilters.elt().  This version
     ensures that the content is stored in a list, not a tuple.
     """
-    def Element(*value):  # pylint: disable=invalid-name
-        """Creates an element."""
-        el = _elt(eltType, numargs)(*value)
-        if type(el['c']) == tuple:
-            el['c'] = list(el['c'])  # The content should be a list, not tuple
-        return el
-    return Element
+    key = (eltType, numargs)
+    if not key in _ELTS:
+        _ELTS[key] = _make_element_constructor(eltType, numargs)
+    return _ELTS[key]
 
 Cite = elt('Cite', 2)  # pylint: disable=invalid-name
 
 def _getel(key, value):
     """Returns an element given a key and value."""
-    if key in ['HorizontalRule', 'Null']:
-        return elt(key, 0)()
-    elif key in ['Plain', 'Para', 'BlockQuote', 'BulletList',
-                 'DefinitionList', 'HorizontalRule', 'Null']:
-        return elt(key, 1)(value)
+    numargs = _NUMARGS.get(key)
+    if numargs == 0:
+        return {'t':key, 'c':[]}
+    elif numargs == 1:
+        return {'t':key, 'c':value}
     else:
-        return elt(key, len(value))(*value) # pylint: disable=star-args
+        return {'t':key, 'c':list(value)}
+
+def _clone(x):
+    """Returns a copy of the element or element list 'x'.  This is much
+    faster than copy.deepcopy() for json data."""
+    if isinstance(x, list):
+        return [_clone(v) for v in x]
+    elif isinstance(x, dict):
+        return {k: _clone(v) for k, v in x.items()}
+    return x
 
 
 #=============================================================================
@@ -315,6 +1642,74 @@ def dollarfy(x):
 
 # extract_attrs() ------------------------------------------------------------
 
+# Attributes were once parsed by applying quotify(), dollarfy() and
+# stringify() to the elements, and then passing the string to
+# PandocAttributes.  That is slow when there are thousands of attributes in a
+# document.  The elements are now converted to text as they are scanned for
+# the end of the attributes, and the text is parsed with a precompiled
+# regex.  The results are the same.
+
+# Splits attribute strings at spaces and newlines outside of quotes
+_ATTRSPLIT = re.compile(r'''((?:[^ \n"']|"[^"]*"|'[^']*')+)''')
+
+def _get_text(x, pieces):
+    """Appends the text of element or element list 'x' to 'pieces'.  The
+    text is the same as for stringify(dollarfy(quotify(x)))."""
+    if isinstance(x, list):
+        for v in x:
+            _get_text(v, pieces)
+    elif isinstance(x, dict):
+        if not 't' in x:  # Not an element
+            for v in x.values():
+                _get_text(v, pieces)
+            return
+        key, value = x['t'], x.get('c')
+        if key in ['Str', 'MetaString']:
+            pieces.append(value)
+        elif key in ['Space', 'SoftBreak', 'LineBreak']:
+            pieces.append(' ')
+        elif key == 'Code':
+            pieces.append(value[1])
+        elif key == 'Math':
+            pieces.append('$' + value[1] + '$')
+        elif key == 'Quoted':
+            quote = '"' if value[0]['t'] == 'DoubleQuote' else "'"
+            pieces.append(quote)
+            for v in value[1]:
+                # quotify() leaves off the quotes for Quoted elements directly
+                # inside of Quoted elements
+                _get_text(v['c'][1] if isinstance(v, dict) and \
+                          v.get('t') == 'Quoted' else v, pieces)
+            pieces.append(quote)
+        elif value is not None:
+            _get_text(value, pieces)
+
+def _parse_attrs(attrstr):
+    """Parses the markdown attributes string 'attrstr' in the same way as
+    PandocAttributes, but also removes quotes from the values of key-value
+    pairs.  Returns the attributes in pandoc format."""
+
+    attrstr = attrstr.strip('{}')
+    words = _ATTRSPLIT.split(attrstr)[1::2]
+
+    # A single word is a class (e.g., ```python)
+    if len(words) == 1 and not attrstr.startswith(('#', '.')) \
+      and '=' not in attrstr:
+        return ['', [attrstr], []]
+
+    ids = [word[1:] for word in words if word.startswith('#')]
+    classes = [word[1:] for word in words if word.startswith('.')] + \
+      ['unnumbered' for word in words if word == '-']
+    kvs = collections.OrderedDict(word.split('=', 1) for word in words
+                                  if '=' in word)
+
+    # Remove extranneous quotes from kvs
+    for k, v in kvs.items():
+        if v[0] == v[-1] == '"' or v[0] == "'" == v[-1] == "'":
+            kvs[k] = v[1:-1]
+
+    return [ids[0] if ids else '', classes, [[k, v] for k, v in kvs.items()]]
+
 def extract_attrs(x, n):
     """Extracts attributes from element list 'x' beginning at index 'n'.
 
@@ -333,12 +1728,15 @@ def extract_attrs(x, n):
     # It starts with {, so this *may* be an attributes list.  Search for where
     # the attributes end.  Do not consider } in quoted elements.
 
-    seq = []          # A sequence of saved values
+    pieces = []       # The text of the attributes
     quotechar = None  # Used to keep track of quotes in strings
     flag = False      # Flags that an attributes list was found
     i = 0             # Initialization
 
-    for i, v in enumerate(x[n:]):  # Scan through the list
+    # Nothing is copied here: the scan is by index rather than over a slice of
+    # 'x', and a Str that must be split is split using a new Str for the tail.
+    for i in range(len(x) - n):  # Scan through the list
+        v = x[n+i]
         if v and v['t'] == 'Str':
             # Scan for } outside of a quote
             for j, c in enumerate(v['c']):
@@ -348,13 +1746,11 @@ def extract_attrs(x, n):
                     quotechar = c
                 elif c == '}' and quotechar is None:  # The attributes end here
                     # Split the string at the } and save the pieces
-                    head, tail = v['c'][:j+1], v['c'][j+1:]
-                    x[n+i] = copy.deepcopy(v)
-                    x[n+i]['c'] = tail
-                    v['c'] = head
+                    x[n+i] = Str(v['c'][j+1:])
+                    v['c'] = v['c'][:j+1]
                     flag = True
                     break
-        seq.append(v)
+        _get_text(v, pieces)
         if flag:
             break
 
@@ -366,20 +1762,14 @@ def extract_attrs(x, n):
         del x[n:n+i]
 
         # Process the attrs
-        attrstr = stringify(dollarfy(quotify(seq))).strip()
-        attrs = PandocAttributes(attrstr, 'markdown').to_pandoc()
-
-        # Remove extranneous quotes from kvs
-        for i, (k, v) in enumerate(attrs[2]):  # pylint: disable=unused-variable
-            if v[0] == v[-1] == '"' or v[0] == "'" == v[-1] == "'":
-                attrs[2][i][1] = attrs[2][i][1][1:-1]
-
-        # We're done
-        return attrs
+        return _parse_attrs(''.join(pieces).strip())
 
     # Attributes not found
     raise ValueError('Attributes not found.')
 
+if os.environ.get('XNOS_PROFILE'):
+    extract_attrs = get_profile().wrap(extract_attrs)
+
 
 #=============================================================================
 # Actions and their factory functions
@@ -398,29 +1788,37 @@ def extract_attrs(x, n):
 
 # The design pattern used by this function is repeated by other actions,
 # below. Processing of an element list 'x' is relegated to a helper.  The
-# helper processes the list iteratively.  Processing is restarted (through use
-# of the _repeat() decorator) any time the element list is changed.  A value
-# of None is returned by the outer function because all modifications are made
-# in place.
-
-@_repeat
-def _join_strings(x):
+# helper processes the list iteratively.  Any time the element list is changed
+# the helper returns the index from which processing should continue (through
+# use of the _scan() decorator).  That index is chosen so that every element
+# affected by the change is looked at again.  A value of None is returned by
+# the outer function because all modifications are made in place.
+
+@_scan
+def _join_strings(x, start):
     """Joins adjacent Str elements found in the element list 'x'."""
-    for i in range(len(x)-1):  # Process successive pairs of elements
+    for i in range(start, len(x)-1):  # Process successive pairs of elements
         if x[i]['t'] == 'Str' and x[i+1]['t'] == 'Str':
             x[i]['c'] += x[i+1]['c']
             del x[i+1]  # In-place deletion of element from list
-            return  # Forces processing to repeat
-    return True  # Terminates processing
+            return i  # The joined string may be joined again
+    return None  # Terminates processing
+
+def _join_strings_factory(context):
+    """Returns the join_strings() action for the DocumentContext
+    'context'."""
+
+    @acts_on(*_INLINELISTS, local=True)
+    def join_strings(key, value, fmt, meta):  # pylint: disable=unused-argument
+        """Joins adjacent Str elements in the 'value' list."""
+        get_inlines = context.ast.inlinelists.get(key)
+        if get_inlines:
+            # pylint: disable=no-value-for-parameter
+            _join_strings(get_inlines(value))
 
-def join_strings(key, value, fmt, meta):  # pylint: disable=unused-argument
-    """Joins adjacent Str elements in the 'value' list."""
-    if key in ['Para', 'Plain']:
-        _join_strings(value)
-    elif key == 'Image':
-        _join_strings(value[-2])
-    elif key == 'Table':
-        _join_strings(value[-5])
+    return join_strings
+
+join_strings = _DEFAULT_CONTEXT.join_strings
 
 
 # repair_reference() ---------------------------------------------------------
@@ -430,89 +1828,121 @@ def join_strings(key, value, fmt, meta):  # pylint: disable=unused-argument
 # >>> _REF.match('xxx{+@fig:1}xxx').groups()
 # ('xxx{+', 'fig:1', '}xxx').
 _REF = re.compile(r'^((?:.*{)?[\*\+!]?)@([^:]*:[\w/-]+)(.*)')
-def _is_broken_ref(key1, value1, key2, value2):
-    """True if this is a broken reference; False otherwise."""
-    # A link followed by a string may represent a broken reference
-    if key1 != 'Link' or key2 != 'Str':
-        return False
-    # Assemble the parts
-    n = 0 if _PANDOCVERSION < '1.16' else 1
-
-    if type(value1[n][0]['c']) == list:
+
+def _match_broken_ref(link, string, n):
+    """Returns the _REF match if the 'link' element followed by the 'string'
+    element is a broken reference; None otherwise.  'n' is the index of the
+    link text in the Link element value."""
+    text = link['c'][n][0]['c']
+    if type(text) == list:
         # Occurs when there is quoted text in an actual link.  This is not
         # a broken link.  See Issue #1.
-        return False
-
-    s = value1[n][0]['c'] + value2
-    # Return True if this matches the reference regex
-    return True if _REF.match(s) else False
-
-@_repeat
-def _repair_refs(x):
+        return None
+    return _REF.match(text + string['c'])
+
+# The repair is done in one pass.  Elements are moved from 'x' to a new list
+# one at a time.  A Str that completes a broken reference with the Link at
+# the end of the new list is replaced by the reference's prefix, Cite and
+# suffix.  When the prefix is joined onto the Str before the Link, that Str
+# may complete a broken reference with the Link before it, and so it is
+# checked again in the same way.  Each check consumes a Link, and so the
+# time taken is linear in the length of 'x'.
+
+def _repair_refs(x, context):
     """Performs the repair on the element list 'x'."""
 
-    if _PANDOCVERSION is None:
+    if context.pandocversion is None:
         raise RuntimeError('Module uninitialized.  Please call init().')
 
-    # Scan the element list x
-    for i in range(len(x)-1):
-
-        # Check for broken references
-        if _is_broken_ref(x[i]['t'], x[i]['c'] if 'c' in x[i] else [],
-                          x[i+1]['t'], x[i+1]['c'] if 'c' in x[i+1] else []):
-
-            # Get the reference string
-            n = 0 if _PANDOCVERSION < '1.16' else 1
-            s = x[i]['c'][n][0]['c'] + x[i+1]['c']
-
-            # Chop it into pieces.  Note that the prefix and suffix may be
-            # parts of other broken references.
-            prefix, label, suffix = _REF.match(s).groups()
-
-            # Insert the suffix, label and prefix back into x.  Do it in this
-            # order so that the indexing works.
-            if len(suffix):
-                x.insert(i+2, Str(suffix))
-            x[i+1] = Cite(
+    n = context.ast.linktext  # Index of the link text
+
+    array = []
+    for v in x:
+        tail = []  # Elements that follow v
+        while v is not None and v['t'] == 'Str' and array and \
+          array[-1]['t'] == 'Link':
+            m = _match_broken_ref(array[-1], v, n)
+            if m is None:
+                break
+
+            # Replace the Link and Str with the pieces of the reference
+            prefix, label, suffix = m.groups()
+            del array[-1]
+            tail[:0] = [Cite(
                 [{"citationId":label,
                   "citationPrefix":[],
                   "citationSuffix":[],
                   "citationNoteNum":0,
                   "citationMode":{"t":"AuthorInText", "c":[]},
                   "citationHash":0}],
-                [Str('@' + label)])
-            if len(prefix):
-                if i > 0 and x[i-1]['t'] == 'Str':
-                    x[i-1]['c'] = x[i-1]['c'] + prefix
-                    del x[i]
-                else:
-                    x[i] = Str(prefix)
+                [Str('@' + label)])] + ([Str(suffix)] if suffix else [])
+            if not prefix:
+                v = None
+            elif array and array[-1]['t'] == 'Str':  # Check it again
+                v = array.pop()
+                v['c'] = v['c'] + prefix
             else:
-                del x[i]
+                v = Str(prefix)
+        if v is not None:
+            array.append(v)
+        array.extend(tail)
 
-            return  # Forces processing to repeat
+    x[:] = array
 
-    return True  # Terminates processing
+def _repair_refs_factory(context):
+    """Returns the repair_refs() action for the DocumentContext
+    'context'."""
 
-def repair_refs(key, value, fmt, meta):  # pylint: disable=unused-argument
-    """Using "-f markdown+autolink_bare_uris" with pandoc splits a reference
-    like "{@fig:one}" into email Link and Str elements.  This function
-    replaces the mess with the Cite and Str elements we normally get.  Call
-    this before any reference processing."""
+    @acts_on(*_INLINELISTS, local=True)
+    def repair_refs(key, value, fmt, meta):  # pylint: disable=unused-argument
+        """Using "-f markdown+autolink_bare_uris" with pandoc splits a
+        reference like "{@fig:one}" into email Link and Str elements.  This
+        function replaces the mess with the Cite and Str elements we
+        normally get.  Call this before any reference processing."""
 
-    if _PANDOCVERSION >= '1.18':
-        return
+        if not context.ast.brokenrefs:
+            return
+
+        # The problem spans multiple elements, and so can only be identified
+        # in element lists.  Element lists are encapsulated in different
+        # ways.  We must process them all.
 
-    # The problem spans multiple elements, and so can only be identified in
-    # element lists.  Element lists are encapsulated in different ways.  We
-    # must process them all.
+        get_inlines = context.ast.inlinelists.get(key)
+        if get_inlines:
+            _repair_refs(get_inlines(value), context)
 
-    if key in ('Para', 'Plain'):
-        _repair_refs(value)
-    elif key == 'Image':
-        _repair_refs(value[-2])
-    elif key == 'Table':
-        _repair_refs(value[-5])
+    return repair_refs
+
+repair_refs = _DEFAULT_CONTEXT.repair_refs
+
+
+# LabelRegistry --------------------------------------------------------------
+
+# Filters number their target elements (figures, equations, tables, ...) and
+# then process references to them.  Testing references against a list of
+# labels is linear in the number of labels.  A LabelRegistry indexes the
+# labels and their numbers instead.
+
+class LabelRegistry(collections.OrderedDict):
+    """An index of labels and their numbers (or string tags), in the order
+    they were added.
+
+    Fill it while numbering the target elements.  Then pass it as 'labels' to
+    process_refs_factory(), and as 'references' to replace_refs_factory()."""
+
+    def __init__(self, *args, **kwargs):
+        self.count = 0  # The last number assigned by add()
+        super(LabelRegistry, self).__init__(*args, **kwargs)
+
+    def add(self, label, number=None):
+        """Registers 'label' with the given 'number' or string tag.  If
+        'number' is None then the next number in sequence is used.  Returns
+        the number."""
+        if number is None:
+            self.count += 1
+            number = self.count
+        self[label] = number
+        return number
 
 
 # process_refs_factory() -----------------------------------------------------
@@ -522,21 +1952,27 @@ def _get_label(key, value):
     assert key == 'Cite'
     return value[-1][0]['c'][1:]
 
-def _extract_modifier(x, i, attrs):
+def _get_modifier(attrs):
+    """Gets the modifier from a reference's pandoc 'attrs', or None."""
+    modifier = None
+    for k, v in attrs[2]:
+        if k == 'modifier':
+            modifier = v  # The last one is used
+    return modifier
+
+def _extract_modifier(x, i, attrs, context):
     """Extracts the */+/! modifier in front of the Cite at index 'i' of the
     element list 'x'.  The modifier is stored in 'attrs'.  Returns the updated
     index 'i'."""
 
-    global _CLEVEREFTEX  # pylint: disable=global-statement
-
     assert x[i]['t'] == 'Cite'
     assert i > 0
 
     # Check the previous element for a modifier in the last character
     if x[i-1]['t'] == 'Str':
         modifier = x[i-1]['c'][-1]
-        if not _CLEVEREFTEX and modifier in ['*', '+']:
-            _CLEVEREFTEX = True
+        if not context.clevereftex and modifier in ['*', '+']:
+            context.clevereftex = True
         if modifier in ['*', '+', '!']:
             attrs[2].append(['modifier', modifier])
             if len(x[i-1]['c']) > 1:  # Lop the modifier off of the string
@@ -571,14 +2007,15 @@ def _remove_brackets(x, i):
         else:
             del x[i-1]
 
-@_repeat
-def _process_refs(x, labels):
+@_scan
+def _process_refs(x, start, labels, context):
     """Strips surrounding curly braces and adds modifiers to the
     attributes of Cite elements.  Only references with labels in the 'labels'
     list are processed."""
 
     # Scan the element list x for Cite elements with known labels
-    for i, v in enumerate(x):
+    for i in range(start, len(x)):
+        v = x[i]
         if v['t'] == 'Cite' and len(v['c']) == 2 and \
           _get_label(v['t'], v['c']) in labels:
 
@@ -588,7 +2025,7 @@ def _process_refs(x, labels):
             # Extract the modifiers.  'attrs' is updated in place.  Element
             # deletion could change the index of the Cite being processed.
             if i > 0:
-                i = _extract_modifier(x, i, attrs)
+                i = _extract_modifier(x, i, attrs, context)
 
             # Attach the attributes
             v['c'].insert(0, attrs)
@@ -597,16 +2034,18 @@ def _process_refs(x, labels):
             if i > 0 and i < len(x)-1:
                 _remove_brackets(x, i)
 
-            # The element list may be changed
-            return  # Forces processing to repeat
+            # Elements around the Cite may have been deleted.  The Cite
+            # itself is now at i or i-1, and won't be processed again.
+            return max(i-1, 0)
 
-    return True  # Terminates processing
+    return None  # Terminates processing
 
 
-def process_refs_factory(labels):
+def process_refs_factory(labels, context=None):
     """Returns process_refs(key, value, fmt, meta) action that processes
     text around a reference.  Only references with labels found in the
-    'labels' list are processed.
+    'labels' list (or LabelRegistry, set, dict, ...) are processed.  The
+    'context' is the DocumentContext, if not the default one.
 
     Consider the markdown "{+@fig:1}", which represents a reference to a
     figure. "@" denotes a reference, "fig:1" is the reference's label, and
@@ -619,17 +2058,32 @@ def process_refs_factory(labels):
     altogether.
     """
 
+    if context is None:
+        context = _DEFAULT_CONTEXT
+
+    # Membership tests on a list are linear.  Index the list instead, and
+    # index it again if it grows.
+    index = [labels, 0]  # The labels index and the length of the list
+
+    def _get_index():
+        """Returns an index for the labels."""
+        if isinstance(labels, list) and len(labels) != index[1]:
+            index[:] = [frozenset(labels), len(labels)]
+        return index[0]
+
     # pylint: disable=unused-argument
+    @acts_on(*_INLINELISTS, local=True)
     def process_refs(key, value, fmt, meta):
         """Instates Ref elements."""
         # References may occur in a variety of places; we must process them
         # all.
-        if key in ['Para', 'Plain']:
-            _process_refs(value, labels)
-        elif key == 'Image':
-            _process_refs(value[-2], labels)
-        elif key == 'Table':
-            _process_refs(value[-5], labels)
+        get_inlines = context.ast.inlinelists.get(key)
+        if get_inlines:
+            # pylint: disable=no-value-for-parameter
+            _process_refs(get_inlines(value), _get_index(), context)
+
+    # The results depend upon the labels (see BlockCache)
+    process_refs.cachekey = lambda: sorted(_get_index())
 
     return process_refs
 
@@ -637,7 +2091,7 @@ def process_refs_factory(labels):
 # replace_refs_factory() ------------------------------------------------------
 
 def replace_refs_factory(references, cleveref_default, plusname, starname,
-                         target):
+                         target, context=None):
     """Returns replace_refs(key, value, fmt, meta) action that replaces
     references with format-specific content.  The content is determined using
     the 'references' dict, which associates reference labels with numbers or
@@ -647,12 +2101,14 @@ def replace_refs_factory(references, cleveref_default, plusname, starname,
     or string tag.  The 'plusname' and 'starname' lists give the singular
     and plural names for "+" and "*" clever references, respectively.  The
     'target' is the LaTeX type for clever referencing (e.g., "figure",
-    "equation", "table", ...)."""
+    "equation", "table", ...).  The 'context' is the DocumentContext, if
+    not the default one."""
 
-    global _CLEVEREFTEX  # pylint: disable=global-statement
+    if context is None:
+        context = _DEFAULT_CONTEXT
 
-    # Update global if clever referencing is required by default
-    _CLEVEREFTEX = _CLEVEREFTEX or cleveref_default
+    # Update the context if clever referencing is required by default
+    context.clevereftex = context.clevereftex or cleveref_default
 
     def _cleveref_tex(key, value, meta):
         r"""Produces TeX to support clever referencing in LaTeX documents.
@@ -664,8 +2120,6 @@ def replace_refs_factory(references, cleveref_default, plusname, starname,
         TeX is inserted into the value.  Replacement elements are returned.
         """
 
-        global _CLEVEREFTEX  # pylint: disable=global-statement
-
         comment1 = '% pandoc-xnos: cleveref formatting'
         tex1 = [comment1,
                 r'\crefformat{%s}{%s~#2#1#3}'%(target, plusname[0]),
@@ -675,13 +2129,14 @@ def replace_refs_factory(references, cleveref_default, plusname, starname,
             if value[1].startswith(comment1):
                 # Append the new portion
                 value[1] = value[1] + '\n' + '\n'.join(tex1[1:])
-                _CLEVEREFTEX = False  # Cleveref fakery already installed
+                context.clevereftex = False  # Cleveref fakery already installed
 
         elif key != 'RawBlock':  # Write the cleveref TeX
-            _CLEVEREFTEX = False  # Cancels further attempts
+            context.clevereftex = False  # Cancels further attempts
             ret = []
-            if not 'xnos-cleveref-fake' in meta or \
-              get_meta(meta, 'xnos-cleveref-fake'):
+            metadata = get_metadata(meta, context)
+            if not 'xnos-cleveref-fake' in metadata or \
+              metadata['xnos-cleveref-fake']:
                 # Cleveref fakery
                 tex2 = [
                     r'% pandoc-xnos: cleveref fakery',
@@ -699,32 +2154,54 @@ def replace_refs_factory(references, cleveref_default, plusname, starname,
             ret.append(RawBlock('tex', '\n'.join(tex1)))
             return ret
 
+    # Replacements are the same for every reference with the same label,
+    # modifier and format, and so they are made once and copied thereafter.
+    # The replacements are keyed by everything else they depend upon too (the
+    # reference's text, the names, the cleveref fakery and the AST), so that
+    # changes to these between calls and across documents are respected.
+    replacements = {}  # Maps keys to replacements
+
     def _cite_replacement(key, value, fmt, meta):
         """Returns context-dependent content to replace a Cite element."""
 
         assert key == 'Cite'
 
-        attrs, label = value[0], _get_label(key, value)
-        attrs = PandocAttributes(attrs, 'pandoc')
+        label = _get_label(key, value)
+        modifier = _get_modifier(value[0])
 
         assert label in references
 
-        # Get the replacement value
-        text = str(references[label])
+        fake = False
+        if fmt == 'latex':
+            metadata = get_metadata(meta, context)
+            fake = not 'xnos-cleveref-fake' in metadata or \
+              bool(metadata['xnos-cleveref-fake'])
+        args = (label, modifier, str(fmt), str(references[label]),
+                plusname[0], starname[0], fake, context.ast)
+        if not args in replacements:
+            replacements[args] = _make_replacement(*args)
+        return _clone(replacements[args])
+
+    # pylint: disable=too-many-arguments
+    def _make_replacement(label, modifier, fmt, text, plusname0, starname0,
+                          fake, ast):
+        """Returns the content to replace a reference to 'label' with the
+        given 'modifier' (None if there isn't one).  The 'text' is the
+        label's number or tag, 'plusname0' and 'starname0' are the names for
+        clever references, 'fake' flags that cleveref fakery is used, and
+        'ast' is the _ASTAdapter."""
 
         # Choose between \Cref, \cref and \ref
-        cleveref = attrs['modifier'] in ['*', '+'] \
-          if 'modifier' in attrs.kvs else cleveref_default
-        plus = attrs['modifier'] == '+' if 'modifier' in attrs.kvs \
+        cleveref = modifier in ['*', '+'] if modifier is not None \
           else cleveref_default
-        name = plusname[0] if plus else starname[0]  # Name used by cref
+        plus = modifier == '+' if modifier is not None else cleveref_default
+        name = plusname0 if plus else starname0  # Name used by cref
 
         # The replacement depends on the output format
         if fmt == 'latex':
             if cleveref:
                 # Renew commands needed for cleveref fakery
-                if not 'xnos-cleveref-fake' in meta or \
-                  get_meta(meta, 'xnos-cleveref-fake'):
+                if fake:
                     faketex = (r'\xrefname' if plus else r'\Xrefname') + \
                       '{%s}' % name
                 else:
@@ -738,25 +2215,23 @@ def replace_refs_factory(references, cleveref_default, plusname, starname,
                if text.startswith('$') and text.endswith('$') \
                else Str(text)]
 
-            link = elt('Link', 2)(linktext, ['#%s' % label, '']) \
-              if _PANDOCVERSION < '1.16' else \
-              Link(['', [], []], linktext, ['#%s' % label, ''])
+            link = ast.link(linktext, ['#%s' % label, ''])
             ret = ([Str(name), Space()] if cleveref else []) + [link]
 
         return ret
 
+    # The cleveref TeX depends on modifiers found anywhere in the document
+    # by process_refs(), and so a new walk is needed.
+    @acts_on(*(_BLOCKKEYS | set(['Cite'])), newpass=True)
     def replace_refs(key, value, fmt, meta):  # pylint: disable=unused-argument
         """Replaces references with format-specific content."""
 
-        if fmt == 'latex' and _CLEVEREFTEX:
+        if fmt == 'latex' and context.clevereftex:
 
             # Put the cleveref TeX in front of the first block element that
             # isn't a RawBlock.
 
-            if not key in ['Plain', 'Para', 'CodeBlock', 'RawBlock',
-                           'BlockQuote', 'OrderedList', 'BulletList',
-                           'DefinitionList', 'Header', 'HorizontalRule',
-                           'Table', 'Div', 'Null']:
+            if not key in _BLOCKKEYS:
                 return
 
             # Reconstruct the block element
@@ -771,6 +2246,10 @@ def replace_refs_factory(references, cleveref_default, plusname, starname,
 
             return _cite_replacement(key, value, fmt, meta)
 
+    # Only Cite elements are acted upon once the cleveref TeX is placed
+    replace_refs.status = lambda fmt, meta: replace_refs.keys \
+      if fmt == 'latex' and context.clevereftex else _CITEKEYS
+
     return replace_refs
 
 
@@ -802,6 +2281,7 @@ def attach_attrs_factory(f, extract_attrs=extract_attrs, allow_space=False):
                 except (ValueError, IndexError):
                     pass
 
+    @acts_on('Para', 'Plain', local=True)
     def attach_attrs(key, value, fmt, meta):  # pylint: disable=unused-argument
         """Attaches attributes to an element."""
         if key in ['Para', 'Plain']:
@@ -811,6 +2291,10 @@ def attach_attrs_factory(f, extract_attrs=extract_attrs, allow_space=False):
             if len(value) == 1 and value[0]['t'] == 'Image':
                 value[0]['c'][-1][1] = 'fig:'
 
+    attach_attrs.cachekey = lambda: [name, allow_space,
+                                     extract_attrs.__module__,
+                                     extract_attrs.__name__]
+
     return attach_attrs
 
 
@@ -828,6 +2312,7 @@ def detach_attrs_factory(f):
     name = f.__closure__[0].cell_contents
     n = f.__closure__[1].cell_contents
 
+    @acts_on(name, local=True)
     def detach_attrs(key, value, fmt, meta):  # pylint: disable=unused-argument
         """Detaches the attributes."""
         if key == name:
@@ -840,38 +2325,45 @@ def detach_attrs_factory(f):
                 assert type(value[0][2]) is list
                 del value[0]
 
+    detach_attrs.cachekey = lambda: [name, n]
+
     return detach_attrs
 
 
 # insert_secnos_factory() ----------------------------------------------------
 
 # pylint: disable=redefined-outer-name
-def insert_secnos_factory(f):
+def insert_secnos_factory(f, context=None):
     """Returns insert_secnos(key, value, fmt, meta) action that inserts
-    section numbers into the attributes of elements of type f.
+    section numbers into the attributes of elements of type f.  The section
+    numbers are kept in the DocumentContext 'context', if not the default
+    one.
     """
 
     # Get the name
     name = f.__closure__[0].cell_contents
 
+    if context is None:
+        context = _DEFAULT_CONTEXT
+
+    @acts_on('Header', name)
     def insert_secnos(key, value, fmt, meta):  # pylint: disable=unused-argument
         """Inserts section numbers into elements attributes."""
-        global SEC  # pylint: disable=global-statement
 
-        if 'xnos-number-sections' in meta and \
-          meta['xnos-number-sections']['c'] and \
+        if get_metadata(meta, context).isset('xnos-number-sections') and \
           fmt in ['html', 'html5']:
             if key == 'Header':
                 if 'unnumbered' in value[1][1]:
                     return
                 level = value[0]
-                n = level - len(SEC)
+                sec = context.sec
+                n = level - len(sec)
                 if n > 0:
-                    SEC.extend([0]*n)
-                SEC[level-1] += 1
-                SEC = SEC[:MAXLEVEL]
+                    sec.extend([0]*n)
+                sec[level-1] += 1
+                context.sec = sec[:context.maxlevel]
             if key == name:
-                s = '.'.join([str(n) for n in SEC])
+                s = '.'.join([str(n) for n in context.sec])
                 value[0][2].insert(0, ['secno', s])
 
     return insert_secnos
@@ -880,23 +2372,30 @@ def insert_secnos_factory(f):
 # delete_secnos_factory() ----------------------------------------------------
 
 # pylint: disable=redefined-outer-name
-def delete_secnos_factory(f):
+def delete_secnos_factory(f, context=None):
     """Returns delete_secnos(key, value, fmt, meta) action that deletes
-    section numbers from the attributes of elements of type f.
+    section numbers from the attributes of elements of type f.  The
+    metadata is looked up in the DocumentContext 'context', if not the
+    default one.
     """
 
     # Get the name
     name = f.__closure__[0].cell_contents
 
+    if context is None:
+        context = _DEFAULT_CONTEXT
+
+    @acts_on(name, local=True)
     def delete_secnos(key, value, fmt, meta):  # pylint: disable=unused-argument
         """Deletes section numbers from elements attributes."""
-        if 'xnos-number-sections' in meta and \
-          meta['xnos-number-sections']['c'] and \
+        if get_metadata(meta, context).isset('xnos-number-sections') and \
           fmt in ['html', 'html5']:
             if key == name and len(value[0][2]) and \
               value[0][2][0][0] == 'secno':
                 del value[0][2][0]
 
+    delete_secnos.cachekey = lambda: name
+
     return delete_secnos
 
 
@@ -905,9 +2404,27 @@ def delete_secnos_factory(f):
 def insert_rawblocks_factory(rawblocks):
     r"""Returns insert_rawblocks(key, value, fmt, meta) action that inserts
     non-duplicate RawBlock elements.
+
+    The 'rawblocks' list is emptied once the blocks are placed.
     """
 
+    # Documents may have thousands of RawBlock elements.  Count the pending
+    # blocks by (format, text) so that duplicates are found in constant
+    # time.  The counts are redone whenever the list changes length (e.g.,
+    # when blocks are appended after the factory is called).
+    counts = collections.Counter()
+    counted = [0]  # The length of 'rawblocks' when last counted
+
+    def _is_pending(value):
+        """Returns True if the RawBlock 'value' is in 'rawblocks'."""
+        if counted[0] != len(rawblocks):
+            counts.clear()
+            counts.update(tuple(rawblock['c']) for rawblock in rawblocks)
+            counted[0] = len(rawblocks)
+        return counts[tuple(value)] > 0
+
     # pylint: disable=unused-argument
+    @acts_on(*_BLOCKKEYS)
     def insert_rawblocks(key, value, fmt, meta):
         """Inserts non-duplicate RawBlock elements."""
 
@@ -917,20 +2434,21 @@ def insert_rawblocks_factory(rawblocks):
         # Put the RawBlock elements in front of the first block element that
         # isn't also a RawBlock.
 
-        if not key in ['Plain', 'Para', 'CodeBlock', 'RawBlock',
-                       'BlockQuote', 'OrderedList', 'BulletList',
-                       'DefinitionList', 'Header', 'HorizontalRule',
-                       'Table', 'Div', 'Null']:
+        if not key in _BLOCKKEYS:
             return
 
-        if key == 'RawBlock':  # Remove duplicates
-            rawblock = RawBlock(*value)  # pylint: disable=star-args
-            if rawblock in rawblocks:
-                rawblocks.remove(rawblock)
-                return
+        if key == 'RawBlock' and _is_pending(value):  # Remove duplicates
+            rawblocks.remove(RawBlock(*value))  # pylint: disable=star-args
+            counts[tuple(value)] -= 1
+            counted[0] -= 1
+            return
 
-        if rawblocks:  # Insert blocks
-            el = _getel(key, value)
-            return [rawblocks.pop(0) for i in range(len(rawblocks))] + [el]
+        # Insert blocks
+        el = _getel(key, value)
+        return [rawblocks.pop(0) for i in range(len(rawblocks))] + [el]
+
+    # Finished once the blocks are placed
+    insert_rawblocks.status = lambda fmt, meta: insert_rawblocks.keys \
+      if rawblocks else frozenset()
 
     return insert_rawblocks
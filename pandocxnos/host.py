@@ -0,0 +1,166 @@
+"""host.py: runs several pandoc-xnos filters in a single process.
+
+Usage:
+
+    pandoc --filter pandoc-xnos ...
+
+This replaces a chain of filters like
+
+    pandoc --filter pandoc-fignos --filter pandoc-eqnos \
+           --filter pandoc-tablenos ...
+
+Each filter in a chain is a separate process that starts python and
+imports its libraries, and passes the document through a pipe.  pandoc-xnos
+runs each filter (plugin) in turn in one process, and passes the document
+from one to the next in memory.
+
+The plugins are named in the XNOS_PLUGINS environment variable as a
+comma-separated list of module names.  By default pandoc_fignos,
+pandoc_eqnos and pandoc_tablenos are run if they are installed.
+
+A plugin module may provide filter_doc(doc, fmt), which should alter the
+pandoc json 'doc' for output format 'fmt' and return it.  It should not keep
+state of its own from one document to the next.  Otherwise the plugin's
+main() is called with its STDIN and STDOUT streams replaced, so that the
+document is passed to and from it in memory, and with sys.argv set as pandoc
+would set it for a filter.
+
+A plugin's main() parses and dumps the document itself, and so its json
+text is passed as it is to the next plugin.  The document is only parsed
+and dumped by pandoc-xnos for plugins that provide filter_doc().  Where
+every plugin does, the document is parsed and dumped once.
+"""
+
+# Copyright 2016 Thomas J. Duck.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import io
+import json
+import importlib
+
+from . import core
+
+
+# The plugins run when XNOS_PLUGINS isn't set.  Those not installed are
+# skipped.
+DEFAULT_PLUGINS = ['pandoc_fignos', 'pandoc_eqnos', 'pandoc_tablenos']
+
+
+# load_plugins() -------------------------------------------------------------
+
+def load_plugins(names=None):
+    """Imports and returns the plugin modules given in the 'names' list.
+
+    If 'names' is None then the names are taken from the XNOS_PLUGINS
+    environment variable, or else DEFAULT_PLUGINS is used.  An ImportError is
+    raised if a named plugin cannot be imported, unless it is a default."""
+
+    if names is None and os.environ.get('XNOS_PLUGINS'):
+        names = [name.strip() for name in
+                 os.environ['XNOS_PLUGINS'].split(',') if name.strip()]
+
+    if names is None:
+        plugins = []
+        for name in DEFAULT_PLUGINS:
+            try:
+                plugins.append(importlib.import_module(name))
+            except ImportError:
+                pass
+        return plugins
+
+    return [importlib.import_module(name) for name in names]
+
+
+# run_plugins() --------------------------------------------------------------
+
+def _get_state():
+    """Returns the state that core.py keeps between actions."""
+    # pylint: disable=protected-access
+    return core._CLEVEREFTEX, core.MAXLEVEL, list(core.SEC)
+
+def _set_state(state):
+    """Restores the state returned by _get_state()."""
+    # pylint: disable=protected-access
+    core._CLEVEREFTEX, core.MAXLEVEL, core.SEC = \
+      state[0], state[1], list(state[2])
+
+def _run_main(plugin, text, fmt):
+    """Runs the main() function of 'plugin' on the json 'text' of a document
+    for output format 'fmt'.  Returns the json text that it writes."""
+
+    if sys.version_info > (3,):
+        stdin, stdout = io.StringIO(text), io.StringIO()
+    else:
+        stdin, stdout = io.BytesIO(text), io.BytesIO()
+
+    # The plugin gets the format from its arguments
+    saved = plugin.STDIN, plugin.STDOUT, sys.argv
+    plugin.STDIN, plugin.STDOUT = stdin, stdout
+    sys.argv = [sys.argv[0], fmt]
+    try:
+        plugin.main()
+    finally:
+        plugin.STDIN, plugin.STDOUT, sys.argv = saved
+
+    return stdout.getvalue()
+
+def run_plugins(doc, fmt, plugins):
+    """Runs each of the 'plugins' on the pandoc json 'doc' for output format
+    'fmt'.  The 'doc' may also be given as json text.  Returns the altered
+    document in the same form.
+
+    The document is only converted between json text and the pandoc json
+    when a plugin needs the other form.  Each plugin starts with the same
+    core.py state that it would have in a process of its own."""
+
+    state = _get_state()
+
+    istext = isinstance(doc, tuple(core.STRTYPES))
+    text, doc = (doc, None) if istext else (None, doc)
+
+    for plugin in plugins:
+        _set_state(state)
+        if hasattr(plugin, 'filter_doc'):
+            if doc is None:
+                doc, text = json.loads(text), None
+            doc = plugin.filter_doc(doc, fmt)
+        else:
+            if text is None:
+                text, doc = json.dumps(doc), None
+            text = _run_main(plugin, text, fmt)
+
+    if istext:
+        return json.dumps(doc) if text is None else text
+    return json.loads(text) if doc is None else doc
+
+
+# main() ---------------------------------------------------------------------
+
+def main():
+    """Filters the document on STDIN to STDOUT using the plugins."""
+
+    fmt = sys.argv[1] if len(sys.argv) > 1 else ''
+
+    plugins = load_plugins()
+
+    text = run_plugins(core.STDIN.read(), fmt, plugins)
+    core.STDOUT.write(text)
+    core.STDOUT.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""server.py: runs pandoc-xnos filters in a persistent server.
+
+Usage:
+
+    pandoc-xnos-server &
+    pandoc --filter pandoc-xnos-client ...
+
+Each filter process pays for starting python, importing the filters and
+their libraries, and initializing them.  For small documents this can take
+longer than the filtering does.  pandoc-xnos-server does all of this once,
+and then filters the documents sent to it by pandoc-xnos-client over a Unix
+socket.
+
+The plugins are chosen as for pandoc-xnos (see host.py).  The socket is
+given in the XNOS_SOCKET environment variable, or is a file in
+XDG_RUNTIME_DIR, or else in a private directory in the temporary directory.
+The socket's directory must belong to the user, and no one else may
+access it.  The client checks this too, and where it can, that the server
+is run by the user.
+
+Each document is filtered in a process forked from the server, and so
+starts with the same state that it would have in a process of its own.  The
+client's arguments, working directory and the environment variables that
+the filters read are used.  Messages
+written to STDERR by the plugins go to the server's STDERR.  If the server
+isn't running, or doesn't reply in time, then the client filters the
+document itself.
+"""
+
+# Copyright 2016 Thomas J. Duck.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import stat
+import json
+import struct
+import socket
+import tempfile
+import traceback
+import importlib
+
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver  # pylint: disable=import-error
+
+from . import host
+from .core import STDERR
+
+
+# The modules that core.py imports only when needed.  The server imports them
+# up front so that the forked processes don't have to.
+_LAZY_MODULES = ['psutil', 'subprocess', 'pandocattributes', 'copy',
+                 'textwrap']
+
+
+# get_path() -----------------------------------------------------------------
+
+def get_path():
+    """Returns the path to the server's socket.  It is taken from the
+    XNOS_SOCKET environment variable, or else is a file in the user's
+    XDG_RUNTIME_DIR, or else in the directory pandoc-xnos-UID in the
+    temporary directory (which the server makes private to the user)."""
+    if os.environ.get('XNOS_SOCKET'):
+        return os.environ['XNOS_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR') and \
+      os.path.isdir(os.environ['XDG_RUNTIME_DIR']):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'pandoc-xnos.sock')
+    return os.path.join(tempfile.gettempdir(),
+                        'pandoc-xnos-%d' % os.getuid(), 'server.sock')
+
+
+# Server ---------------------------------------------------------------------
+
+# A request is a line of json giving the client's 'argv' (without the program
+# name), 'environ' (see _get_environ()) and 'cwd', followed by the pandoc json document.  The
+# client shuts down its side of the socket once the document is sent.  The
+# reply is a line of json, followed by the filtered document.  The line holds
+# an 'error' message if the document could not be filtered.
+
+# The environment variables that the filters read.  Only these are sent by
+# the client, and only these are taken by the server.
+_ENVIRON = frozenset(['PATH', 'HOME', 'TMPDIR', 'LANG', 'LANGUAGE',
+                      'XDG_CACHE_HOME', 'PANDOC_VERSION',
+                      'PANDOC_READER_OPTIONS'])
+_ENVIRON_PREFIXES = ('XNOS_', 'LC_')
+
+def _get_environ(environ):
+    """Returns the variables in the 'environ' dict that the filters read."""
+    return dict((name, value) for name, value in environ.items()
+                if name in _ENVIRON or name.startswith(_ENVIRON_PREFIXES))
+
+def _check_dir(path):
+    """Raises an OSError unless the directory of the socket at 'path'
+    belongs to the user, and no one else may access it.  No one else can
+    then replace the socket."""
+    dirname = os.path.dirname(os.path.abspath(path))
+    st = os.stat(dirname)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError('Unsafe directory: %s' % dirname)
+
+def _write_header(stream, header):
+    """Writes the 'header' dict to the binary 'stream' as a line of json."""
+    stream.write((json.dumps(header) + '\n').encode('utf-8'))
+
+def _read_header(stream):
+    """Reads a line of json from the binary 'stream'.  Returns the header
+    dict, or None at the end of the stream."""
+    return json.loads(stream.readline().decode('utf-8') or 'null')
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Filters a document in a forked process."""
+
+    def handle(self):
+        """Handles the request."""
+        try:
+            header = _read_header(self.rfile)
+            if header is None:  # A connection that sent nothing
+                return
+
+            # Take on the client's circumstances
+            sys.argv = [sys.argv[0]] + header['argv']
+            os.environ.clear()
+            os.environ.update(_get_environ(header['environ']))
+            os.chdir(header['cwd'])
+
+            fmt = header['argv'][0] if header['argv'] else ''
+            text = host.run_plugins(self.rfile.read().decode('utf-8'), fmt,
+                                    self.server.plugins)
+
+        except (Exception, SystemExit):  # pylint: disable=broad-except
+            _write_header(self.wfile, {'error': traceback.format_exc()})
+            return
+
+        _write_header(self.wfile, {})
+        self.wfile.write(text.encode('utf-8'))
+
+def _is_listening(path):
+    """Returns True if a server is listening on the socket at 'path'."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Filters the documents sent to the socket at 'path' with the
+    'plugins'.  The plugins default to those given by
+    host.load_plugins().
+
+    A RuntimeError is raised if another server is listening on the socket,
+    if something other than a socket is at 'path', or if the socket's
+    directory doesn't belong to the user or others may access it.  A stale
+    socket is removed.  The socket's directory is made, private to the
+    user, if needed."""
+
+    def __init__(self, path, plugins=None):
+
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o700)
+        try:
+            _check_dir(path)
+        except OSError as e:
+            raise RuntimeError(str(e))
+
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise RuntimeError('Not a socket: %s' % path)
+            if _is_listening(path):
+                raise RuntimeError('Server already listening on %s' % path)
+            os.remove(path)
+
+        for name in _LAZY_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+
+        self.path = path
+        self.plugins = host.load_plugins() if plugins is None else plugins
+
+        # Only the user may connect
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        """Closes the server and removes its socket."""
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# request() ------------------------------------------------------------------
+
+# The client sends its environment to the server, and so it must be sure that
+# the server is the user's own.  Only the user can make a socket that belongs
+# to the user, and only the user can replace it if no one else may access its
+# directory.  Where the system can say who is listening on the socket, the
+# client checks that too once it is connected.
+
+def _check_socket(path):
+    """Raises a socket.error unless 'path' is a socket that belongs to the
+    user, in a directory that belongs to the user, and that no one else may
+    access."""
+    try:
+        _check_dir(path)
+        st = os.stat(path)
+    except OSError as e:
+        raise socket.error(str(e))
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid() or \
+      st.st_mode & 0o077:
+        raise socket.error('Unsafe socket: %s' % path)
+
+def _check_peer(sock):
+    """Raises a socket.error unless the process at the other end of the
+    connected Unix socket 'sock' is run by the user.  Nothing is checked
+    where the system can't say (SO_PEERCRED is Linux-only)."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    size = struct.calcsize('3i')
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET,
+                                                    socket.SO_PEERCRED, size))
+    if uid != os.getuid():
+        raise socket.error('Server run by another user (uid %d)' % uid)
+
+def request(path, argv, data, timeout=60.):
+    """Sends the pandoc json document 'data' (bytes) to the server listening
+    on the socket at 'path', along with the list of arguments 'argv', the
+    working directory of this process and the environment variables that
+    the filters read.  Returns the filtered document as bytes.
+
+    A socket.error is raised if the server can't be reached, if the socket
+    isn't safe to use (see _check_socket() and _check_peer()), or if the server is silent for
+    more than 'timeout' seconds.  A RuntimeError is raised if the document
+    couldn't be filtered."""
+
+    _check_socket(path)
+
+    header = {'argv': argv, 'environ': _get_environ(os.environ),
+              'cwd': os.getcwd()}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        _check_peer(sock)
+        stream = sock.makefile('rwb')
+        try:
+            _write_header(stream, header)
+            stream.write(data)
+            stream.flush()
+            sock.shutdown(socket.SHUT_WR)
+            reply = _read_header(stream)
+            data = stream.read()
+        finally:
+            stream.close()
+    finally:
+        sock.close()
+
+    if reply is None:
+        raise RuntimeError('No reply from server')
+    if 'error' in reply:
+        raise RuntimeError(reply['error'])
+    return data
+
+
+# main() ---------------------------------------------------------------------
+
+def main():
+    """Runs the server.  The socket may be given as the first argument."""
+
+    path = sys.argv[1] if len(sys.argv) > 1 else get_path()
+
+    server = Server(path)
+    STDERR.write('%s: listening on %s\n' % (os.path.basename(sys.argv[0]),
+                                            path))
+    STDERR.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# client() -------------------------------------------------------------------
+
+def client():
+    """Filters the document on STDIN to STDOUT using the server, or
+    in-process if the server can't be reached."""
+
+    if sys.version_info > (3,):
+        stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    else:
+        stdin, stdout = sys.stdin, sys.stdout
+
+    data = stdin.read()
+
+    try:
+        data = request(get_path(), sys.argv[1:], data)
+    except socket.error:
+        fmt = sys.argv[1] if len(sys.argv) > 1 else ''
+        text = host.run_plugins(data.decode('utf-8'), fmt,
+                                host.load_plugins())
+        stdout.write(text.encode('utf-8'))
+        stdout.flush()
+        return
+    except RuntimeError as e:
+        STDERR.write('%s: %s\n' % (os.path.basename(sys.argv[0]), e))
+        STDERR.flush()
+        sys.exit(1)
+
+    stdout.write(data)
+    stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,11 @@ setup(
                       'psutil>=4.1.0'],
 
     packages=['pandocxnos'],
+    entry_points={'console_scripts':[
+        'pandoc-xnos = pandocxnos.host:main',
+        'pandoc-xnos-server = pandocxnos.server:main',
+        'pandoc-xnos-client = pandocxnos.server:client',
+        'pandoc-xnos-batch = pandocxnos.batch:main']},
 
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,401 @@
+#! /usr/bin/env python3
+
+"""Microbenchmarks for pandoc-xnos.
+
+Usage:
+
+    python3 bench.py [name ...]
+
+Runs the named benchmarks, or all of them if no names are given.  Each
+benchmark prints the time and memory used per operation, or the throughput
+in elements (nodes) per second.  Memory is measured using tracemalloc: 'peak'
+is the largest amount of memory in use above the starting point, and
+'blocks' is the number of memory blocks still allocated afterwards (which
+includes the results).
+
+The documents are synthetic (see make_doc()), and so pandoc is not
+required.  Their size may be set for the 'pipeline' and 'cache' benchmarks
+using the environment variables BENCH_PARAGRAPHS, BENCH_FIGURES,
+BENCH_EQUATIONS, BENCH_TABLES and BENCH_REFS.
+"""
+
+# Copyright 2016 Thomas J. Duck.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import io
+import copy
+import json
+import random
+import shutil
+import tempfile
+import time
+import functools
+import tracemalloc
+
+from pandocfilters import Str, Space, Quoted, Math, Emph, Para, Image, Table
+from pandocfilters import Cite, Link, RawBlock, walk
+from pandocfilters import elt as _elt
+
+import pandocxnos
+from pandocxnos import quotify, dollarfy, extract_attrs, walk_actions
+from pandocxnos import filter_stream, load_doc, dump_doc
+from pandocxnos import join_strings, repair_refs
+from pandocxnos import process_refs_factory, replace_refs_factory
+from pandocxnos import attach_attrs_factory, detach_attrs_factory
+from pandocxnos import insert_secnos_factory, delete_secnos_factory
+from pandocxnos import insert_rawblocks_factory
+from pandocxnos import BlockCache
+
+# Pandoc 1.17 is the latest version with broken references to repair
+pandocxnos.init('1.17')
+
+
+#-----------------------------------------------------------------------------
+# Measurements
+
+def measure(func, args):
+    """Calls func(*a) for each tuple 'a' in the 'args' list.  Returns the
+    time, peak memory and number of blocks left allocated, per call.  The
+    memory is measured using the first call."""
+
+    memory = _memory(func, args[0])
+
+    start = time.perf_counter()
+    for a in args[1:]:
+        func(*a)
+    elapsed = time.perf_counter() - start
+
+    return elapsed/(len(args)-1), memory
+
+def _memory(func, a):
+    """Returns the peak memory and blocks left allocated by func(*a)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.clear_traces()
+        result = func(*a)
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'lineno')
+                 if stat.count_diff > 0)
+    return peak, blocks
+
+def report(name, seconds, memory=None):
+    """Prints a measurement."""
+    if memory is None:
+        print('%-24s %10.2f us' % (name, seconds*1e6))
+    else:
+        print('%-24s %10.2f us %10d bytes peak %6d blocks' %
+              (name, seconds*1e6, memory[0], memory[1]))
+
+def report_rate(name, nodes, seconds, memory):
+    """Prints a throughput measurement."""
+    print('%-24s %10.0f nodes/s %10d bytes peak' %
+          (name, nodes/seconds, memory[0]))
+
+
+#-----------------------------------------------------------------------------
+# Synthetic documents
+
+def _cite(label):
+    """Returns a Cite element for 'label' (as given by pandoc 1.17)."""
+    return Cite([{'citationId':label, 'citationPrefix':[],
+                  'citationSuffix':[], 'citationNoteNum':0,
+                  'citationMode':{'t':'AuthorInText', 'c':[]},
+                  'citationHash':0}], [Str('@' + label)])
+
+def make_doc(paragraphs=1000, figures=100, equations=100, tables=100, refs=4):
+    """Returns a pandoc 1.17 json document with the given numbers of
+    paragraphs, figures, equations and tables.  Each paragraph has 'refs'
+    references to the figures, equations and tables, of which every fourth
+    is a broken reference (see repair_refs()).  Each target has attributes,
+    some of which have quoted braces."""
+
+    blocks = []
+    labels = []
+
+    # The targets, with attributes like {#fig:1 .class tag="{B.1}"}
+    for i in range(figures):
+        labels.append('fig:%d' % (i+1))
+        blocks.append(Para([
+            Image(['', [], []], [Str('Figure'), Space(), Str('caption.')],
+                  ['fig%d.png' % (i+1), 'fig:']),
+            Str('{#%s' % labels[-1]), Space(), Str('.class'), Space(),
+            Str('tag="{B.%d}"}' % (i+1))]))
+    for i in range(equations):
+        labels.append('eq:%d' % (i+1))
+        blocks.append(Para([
+            Math({'t':'DisplayMath', 'c':[]}, 'y_%d = m x + b' % (i+1)),
+            Space(), Str('{#%s}' % labels[-1])]))
+    for i in range(tables):
+        labels.append('tbl:%d' % (i+1))
+        blocks.append(Table(
+            [Str('Table'), Space(), Str('caption.'), Space(),
+             Str('{#%s' % labels[-1]), Space(),
+             Quoted({'t':'DoubleQuote', 'c':[]}, [Str('a}b')]), Str('}')],
+            [{'t':'AlignDefault', 'c':[]}]*2, [0, 0],
+            [[Para([Str('A')])], [Para([Str('B')])]],
+            [[[Para([Str('1')])], [Para([Str('2')])]]]*4))
+
+    # The paragraphs, with references to the targets
+    for i in range(paragraphs):
+        inlines = [Str('See')]
+        for j in range(refs):
+            label = labels[(i*refs + j) % len(labels)] if labels else 'fig:1'
+            inlines.append(Space())
+            if j % 4 == 3:  # Broken by autolink_bare_uris
+                prefix, suffix = label.split(':')
+                inlines.extend([
+                    Link(['', [], []], [Str('{+@' + prefix)],
+                         ['mailto:%s' % prefix, '']),
+                    Str(':%s}' % suffix)])
+            else:
+                inlines.extend([Str('{+'), _cite(label), Str('}')])
+            inlines.extend([Space(), Str('and'), Space(),
+                            Emph([Str('some')]), Space(), Str('text.')])
+        blocks.append(Para(inlines))
+
+    # Intersperse the targets
+    random.Random(0).shuffle(blocks)
+
+    return [{'unMeta':{}}, json.loads(json.dumps(blocks))], labels
+
+
+#-----------------------------------------------------------------------------
+# Benchmarks
+
+def bench_extract_attrs(n=10000):
+    """Extracts attributes like {#fig:1 .class tag="B.1"} from Para
+    contents."""
+
+    # The elements following an image
+    src = [Str('{#fig:1'), Space(), Str('.class'), Space(), Str('tag='),
+           Quoted({'t':'DoubleQuote', 'c':[]}, [Str('B.1')]),
+           Space(), Math({'t':'InlineMath', 'c':[]}, 'x'), Str('}.'),
+           Space(), Str('More'), Space(), Str('text.')]
+
+    args = [(copy.deepcopy(src), 0) for _ in range(n)]
+    report('extract_attrs', *measure(extract_attrs, args))
+
+
+def _count_nodes(x):
+    """Returns the number of elements in the tree 'x'."""
+    if isinstance(x, list):
+        return sum(_count_nodes(v) for v in x)
+    elif isinstance(x, dict):
+        return ('t' in x) + sum(_count_nodes(v) for v in x.values())
+    return 0
+
+def bench_dispatch(n=1000000):
+    """Compares the per-node cost of applying actions using a series of
+    pandocfilters.walk() calls, and using walk_actions() with and without
+    the element types declared."""
+
+    # A synthetic document with about 'n' elements
+    para = Para([Str('Word'), Space(), Emph([Str('word')]), Space(),
+                 Str('word.')])
+    blocks = [copy.deepcopy(para) for _ in range(n//_count_nodes([para]))]
+    nodes = _count_nodes(blocks)
+
+    actions = [repair_refs, process_refs_factory([]), join_strings]
+    undeclared = [functools.partial(action) for action in actions]
+
+    def run_walks(x):
+        """Applies the actions using pandocfilters.walk()."""
+        return functools.reduce(lambda x, action: walk(x, action, '', {}),
+                                actions, x)
+
+    # Times are per node
+    for name, func, args in \
+      [('dispatch: walk', run_walks, [blocks]),
+       ('dispatch: undeclared', walk_actions, [blocks, undeclared, '', {}]),
+       ('dispatch: walk_actions', walk_actions, [blocks, actions, '', {}])]:
+        start = time.perf_counter()
+        func(*args)
+        report(name, (time.perf_counter() - start)/nodes)
+
+
+def _getel_1p0(key, value):
+    """The _getel() function from pandoc-xnos 1.0."""
+    def elt(eltType, numargs):  # pylint: disable=invalid-name
+        """The elt() function from pandoc-xnos 1.0."""
+        def Element(*value):  # pylint: disable=invalid-name
+            """Creates an element."""
+            el = _elt(eltType, numargs)(*value)
+            if type(el['c']) == tuple:
+                el['c'] = list(el['c'])
+            return el
+        return Element
+    if key in ['HorizontalRule', 'Null']:
+        return elt(key, 0)()
+    elif key in ['Plain', 'Para', 'BlockQuote', 'BulletList',
+                 'DefinitionList', 'HorizontalRule', 'Null']:
+        return elt(key, 1)(value)
+    else:
+        return elt(key, len(value))(*value) # pylint: disable=star-args
+
+def bench_getel(n=100000):
+    """Compares reconstructing the top-level elements of a synthetic document
+    (as replace_refs() and insert_rawblocks() do) using the pandoc-xnos 1.0
+    _getel() and the current one."""
+
+    doc, _ = make_doc(paragraphs=n*8//10, figures=n//20, equations=n//20,
+                      tables=n//10)
+    blocks = doc[1]
+
+    def reconstruct(getel):
+        """Reconstructs the blocks using 'getel'."""
+        return [getel(block['t'], block['c']) for block in blocks]
+
+    # Times are per block.  The memory is for reconstructing a Table, which
+    # includes the temporary objects.
+    table = [block for block in blocks if block['t'] == 'Table'][0]
+    for name, getel in [('getel: 1.0', _getel_1p0),
+                        ('getel', pandocxnos.core._getel)]:  # pylint: disable=protected-access
+        seconds = measure(reconstruct, [(getel,)]*3)[0]
+        report(name, seconds/len(blocks),
+               _memory(getel, (table['t'], table['c'])))
+
+
+def _get_actions(labels):
+    """Returns the actions that the filters typically use for the document
+    made with 'labels'."""
+    references = dict((label, i+1) for i, label in enumerate(labels))
+    return [
+        ('repair_refs', repair_refs),
+        ('process_refs', process_refs_factory(labels)),
+        ('replace_refs', replace_refs_factory(references, False,
+                                              ['fig.', 'figs.'],
+                                              ['Figure', 'Figures'],
+                                              'figure')),
+        ('attach_attrs(Image)', attach_attrs_factory(Image)),
+        ('attach_attrs(Math)', attach_attrs_factory(Math, allow_space=True)),
+        ('insert_secnos', insert_secnos_factory(Image)),
+        ('delete_secnos', delete_secnos_factory(Image)),
+        ('detach_attrs(Math)', detach_attrs_factory(Math)),
+        ('insert_rawblocks', insert_rawblocks_factory([RawBlock('tex', 'x')])),
+        ('join_strings', join_strings)]
+
+def _get_sizes(paragraphs, figures, equations, tables, refs):
+    """Returns the document sizes as keyword arguments for make_doc().  The
+    defaults given may be overridden using BENCH_* environment variables."""
+    return dict((key, int(os.environ.get('BENCH_' + key.upper(), value)))
+                for key, value in [('paragraphs', paragraphs),
+                                   ('figures', figures),
+                                   ('equations', equations),
+                                   ('tables', tables), ('refs', refs)])
+
+def bench_pipeline():
+    """Measures the throughput of the functions and actions on a large
+    synthetic document."""
+
+    doc, labels = make_doc(**_get_sizes(1000, 100, 100, 100, 4))
+    nodes = _count_nodes(doc)
+    text = json.dumps(doc)
+    meta = {'xnos-number-sections':{'t':'MetaBool', 'c':True}}
+
+    def run(name, func, get_args):
+        """Measures func(*get_args()).  The memory is measured first."""
+        memory = _memory(func, get_args())
+        args = get_args()
+        start = time.perf_counter()
+        func(*args)
+        report_rate(name, nodes, time.perf_counter() - start, memory)
+
+    def fresh():
+        """Returns a fresh copy of the blocks."""
+        return json.loads(text)[1]
+
+    # The functions
+    run('quotify', quotify, lambda: (fresh(),))
+    run('dollarfy', dollarfy, lambda: (fresh(),))
+
+    # Each action in turn, on the blocks as the previous actions left them
+    # (some actions have state, and so new ones are made for each run).
+    for i, (name, _) in enumerate(_get_actions(labels)):
+        get_action = lambda: _get_actions(labels)[i][1]  # pylint: disable=cell-var-from-loop
+        run(name, walk_actions,
+            lambda: (fresh(), [get_action()], 'html', meta))  # pylint: disable=cell-var-from-loop
+        text = json.dumps([doc[0], walk_actions(fresh(), [get_action()],
+                                                'html', meta)])
+    text = json.dumps(doc)
+    run('walk_actions', walk_actions,
+        lambda: (fresh(), [a for _, a in _get_actions(labels)], 'html', meta))
+
+    # Whole documents
+    def load_and_dump(data):
+        """Loads the document from 'data' and dumps it again."""
+        dump_doc(load_doc(io.BytesIO(data)), io.BytesIO())
+    run('load_doc+dump_doc', load_and_dump, lambda: (text.encode('utf-8'),))
+
+    def stream(data):
+        """Filters the document in 'data' using filter_stream()."""
+        filter_stream(lambda doc: [a for _, a in _get_actions(labels)],
+                      'html', io.StringIO(data), io.StringIO())
+    run('filter_stream', stream, lambda: (text,))
+
+
+def bench_cache():
+    """Compares rebuilding a large synthetic document without a BlockCache,
+    and with a cold and a warm one.  The warm rebuild should be the
+    fastest."""
+
+    doc, labels = make_doc(**_get_sizes(2000, 200, 200, 200, 4))
+    text = json.dumps(doc)
+    meta = {'xnos-number-sections':{'t':'MetaBool', 'c':True}}
+
+    path = tempfile.mkdtemp()
+    try:
+        times = {}
+        for name, cache in [('none', None), ('cold', BlockCache(path=path)),
+                            ('warm', BlockCache(path=path))]:
+            blocks = json.loads(text)[1]
+            actions = [a for _, a in _get_actions(labels)]
+            pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+            start = time.perf_counter()
+            walk_actions(blocks, actions, 'html', meta, cache=cache)
+            times[name] = time.perf_counter() - start
+            report('cache: ' + name, times[name])
+        print('%-24s %10.2f' % ('cache: warm/none', times['warm']/times['none']))
+    finally:
+        shutil.rmtree(path)
+
+
+BENCHMARKS = {
+    'extract_attrs': bench_extract_attrs,
+    'dispatch': bench_dispatch,
+    'pipeline': bench_pipeline,
+    'getel': bench_getel,
+    'cache': bench_cache,
+}
+
+
+#-----------------------------------------------------------------------------
+# Main program
+
+def main():
+    """Runs the benchmarks."""
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,21 +19,41 @@
 
 # pylint: disable=eval-used, line-too-long
 
+import os
 import sys
 import unittest
+import tempfile
+import shutil
 import subprocess
-
-from pandocfilters import walk, Math
+import functools
+import copy
+import types
+import json
+import io
+import itertools
+import random
+import threading
+import socket
+
+import pandocfilters
+from pandocfilters import walk, stringify, Math, Str, Space, Quoted, Emph
+from pandocfilters import Cite, Link, Para, RawBlock
 
 from pandocattributes import PandocAttributes
 
 import pandocxnos
+import pandocxnos.host
+import pandocxnos.server
+import pandocxnos.batch
 from pandocxnos import get_meta, elt
+from pandocxnos import acts_on, walk_actions, filter_stream
+from pandocxnos import BlockCache
 from pandocxnos import join_strings
 from pandocxnos import quotify, dollarfy
 from pandocxnos import extract_attrs
 from pandocxnos import attach_attrs_factory, detach_attrs_factory
 from pandocxnos import repair_refs, process_refs_factory, replace_refs_factory
+from pandocxnos import insert_rawblocks_factory
 
 PANDOCVERSION = '1.18'
 PANDOC1p15 = 'pandoc-1.15.2'
@@ -41,6 +61,102 @@ PANDOC1p15 = 'pandoc-1.15.2'
 pandocxnos.init(PANDOCVERSION)
 
 
+#-----------------------------------------------------------------------------
+# Helpers
+
+# pylint: disable=too-few-public-methods
+class _Trickle(object):
+    """A text stream that reads at most 'n' characters at a time."""
+
+    def __init__(self, text, n):
+        self.stream = io.StringIO(text)
+        self.n = n
+
+    def read(self, size):
+        """Reads up to 'size' characters."""
+        return self.stream.read(min(size, self.n))
+
+
+def _extract_attrs_1p0(x, n):
+    """The extract_attrs() function from pandoc-xnos 1.0.  It parses the
+    attributes using PandocAttributes."""
+
+    if not (x[n]['t'] == 'Str' and x[n]['c'].startswith('{')):
+        raise ValueError('Attributes not found.')
+
+    seq = []
+    quotechar = None
+    flag = False
+    i = 0
+
+    for i, v in enumerate(x[n:]):
+        if v and v['t'] == 'Str':
+            for j, c in enumerate(v['c']):
+                if c == quotechar:
+                    quotechar = None
+                elif c in ['"', "'"]:
+                    quotechar = c
+                elif c == '}' and quotechar is None:
+                    head, tail = v['c'][:j+1], v['c'][j+1:]
+                    x[n+i] = copy.deepcopy(v)
+                    x[n+i]['c'] = tail
+                    v['c'] = head
+                    flag = True
+                    break
+        seq.append(v)
+        if flag:
+            break
+
+    if flag:
+        if x[n+i]['t'] == 'Str' and not x[n+i]['c']:
+            del x[n+i]
+        del x[n:n+i]
+        attrstr = stringify(dollarfy(quotify(seq))).strip()
+        attrs = PandocAttributes(attrstr, 'markdown').to_pandoc()
+        for i, (k, v) in enumerate(attrs[2]):  # pylint: disable=unused-variable
+            if v[0] == v[-1] == '"' or v[0] == "'" == v[-1] == "'":
+                attrs[2][i][1] = attrs[2][i][1][1:-1]
+        return attrs
+
+    raise ValueError('Attributes not found.')
+
+
+def _repair_refs_1p0(x):
+    """The _repair_refs() function from pandoc-xnos 1.0 for pandoc 1.16 and
+    1.17.  It starts again from the beginning after each repair."""
+
+    # pylint: disable=protected-access
+    i = 0
+    while i < len(x)-1:
+        if x[i]['t'] == 'Link' and x[i+1]['t'] == 'Str' and \
+          type(x[i]['c'][1][0]['c']) != list and \
+          pandocxnos.core._REF.match(x[i]['c'][1][0]['c'] + x[i+1]['c']):
+            s = x[i]['c'][1][0]['c'] + x[i+1]['c']
+            prefix, label, suffix = pandocxnos.core._REF.match(s).groups()
+            if len(suffix):
+                x.insert(i+2, Str(suffix))
+            x[i+1] = Cite(
+                [{"citationId":label,
+                  "citationPrefix":[],
+                  "citationSuffix":[],
+                  "citationNoteNum":0,
+                  "citationMode":{"t":"AuthorInText", "c":[]},
+                  "citationHash":0}],
+                [Str('@' + label)])
+            if len(prefix):
+                if i > 0 and x[i-1]['t'] == 'Str':
+                    x[i-1]['c'] = x[i-1]['c'] + prefix
+                    del x[i]
+                else:
+                    x[i] = Str(prefix)
+            else:
+                del x[i]
+            i = 0
+        else:
+            i += 1
+    return x
+
+
 #-----------------------------------------------------------------------------
 # Test class
 
@@ -48,6 +164,109 @@ pandocxnos.init(PANDOCVERSION)
 class TestXnos(unittest.TestCase):
     """Test the pandocxnos package."""
 
+    def test_import(self):
+        """Tests that importing pandocxnos stays cheap."""
+
+        # Modules that should only be loaded when they are needed
+        deferred = ['psutil', 'subprocess', 'pandocattributes', 'copy',
+                    'textwrap']
+
+        code = 'import sys; import pandocxnos; ' \
+          'print(sorted(set(sys.modules) & set(%s)))' % repr(deferred)
+        output = subprocess.check_output([sys.executable, '-c', code])
+
+        self.assertEqual(eval(output.decode('utf-8')), [])
+
+        # A coarse bound on the import time, as reported by -X importtime
+        if sys.version_info >= (3, 7):
+            output = subprocess.check_output(
+                [sys.executable, '-X', 'importtime', '-c',
+                 'import pandocxnos'], stderr=subprocess.STDOUT)
+            lines = [line for line in output.decode('utf-8').splitlines()
+                     if line.split('|')[-1].strip() == 'pandocxnos']
+            self.assertEqual(len(lines), 1)
+            self.assertLess(int(lines[0].split('|')[1]), 500000)
+
+
+    def test_streams(self):
+        """Tests that STDIN and STDOUT pass for text streams."""
+
+        code = 'import io; from pandocxnos import STDIN, STDOUT; ' \
+          'line = next(STDIN); ' \
+          'assert isinstance(STDOUT, io.TextIOBase); ' \
+          'STDOUT.write(line)\n' \
+          'with STDOUT:\n' \
+          '    STDOUT.write(next(STDIN))\n' \
+          'assert STDOUT.closed'
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         input='a\u00e9\nb\n'.encode('utf-8'))
+
+        self.assertEqual(output.decode('utf-8'), 'a\u00e9\nb\n')
+
+
+    @unittest.skipIf(os.name == 'nt', 'Uses a shell script')
+    def test_init_1(self):
+        """Tests init() #1."""
+
+        tmpdir = tempfile.mkdtemp()
+        environ = os.environ.copy()
+        try:
+            os.environ.pop('PANDOC_VERSION', None)
+            os.environ['XNOS_CACHE_DIR'] = os.path.join(tmpdir, 'cache')
+            os.environ['PATH'] = tmpdir
+
+            # Make a fake pandoc
+            pandoc = os.path.join(tmpdir, 'pandoc')
+            def write_pandoc(script, mtime):
+                """Writes the fake pandoc script."""
+                with open(pandoc, 'w') as f:
+                    f.write('#! /bin/sh\n' + script + '\n')
+                os.chmod(pandoc, 0o755)
+                os.utime(pandoc, (mtime, mtime))
+
+            # The version is determined by a call to pandoc
+            write_pandoc('echo "pandoc 1.17.2"', 1000000000)
+            self.assertEqual(pandocxnos.init(), '1.17.2')
+
+            # The cached version is used if pandoc is unchanged
+            write_pandoc('exit 1', 1000000000)
+            self.assertEqual(pandocxnos.init(), '1.17.2')
+
+            # The cache is not used if pandoc was modified
+            write_pandoc('echo "pandoc 1.16"', 1000000001)
+            self.assertEqual(pandocxnos.init(), '1.16')
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(tmpdir)
+            pandocxnos.init(PANDOCVERSION)
+
+
+    def test_init_2(self):
+        """Tests init() #2."""
+
+        environ = os.environ.copy()
+        try:
+            os.environ['PANDOC_VERSION'] = '1.19.1'
+            self.assertEqual(pandocxnos.init('1.17.2'), '1.19.1')
+            del os.environ['PANDOC_VERSION']
+            self.assertEqual(pandocxnos.init(doc={'pandoc-api-version':[1, 17],
+                                                  'meta':{}, 'blocks':[]}),
+                             '1.18')
+            self.assertEqual(pandocxnos.init(doc={'pandoc-api-version':
+                                                  [1, 22, 2, 1],
+                                                  'meta':{}, 'blocks':[]}),
+                             '2.10')
+            self.assertEqual(pandocxnos.init('3.1.1'), '3.1.1')
+            self.assertEqual(pandocxnos.init((2, 19, 2)), '2.19.2')
+            self.assertRaises(RuntimeError, pandocxnos.init, '2.x')
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            pandocxnos.init(PANDOCVERSION)
+
+
     def test_get_meta_1(self):
         """Tests get_meta() #1."""
 
@@ -132,6 +351,32 @@ class TestXnos(unittest.TestCase):
         self.assertEqual(get_meta(src['meta'], 'foo'), expected)
 
 
+    def test_get_metadata(self):
+        """Tests get_metadata()."""
+
+        # Hand-coded
+        src = eval(r'''{"meta":{"xnos-cleveref-fake":{"t":"MetaBool","c":False},"xnos-number-sections":{"t":"MetaInlines","c":[{"t":"Str","c":"On"}]},"foo":{"t":"MetaList","c":[{"t":"MetaInlines","c":[{"t":"Str","c":"bar"}]}]},"baz":{"t":"MetaMap","c":{}}},"blocks":[],"pandoc-api-version":[1,17,0,4]}''')
+
+        metadata = pandocxnos.get_metadata(src['meta'])
+
+        # The object is made once per document
+        self.assertIs(pandocxnos.get_metadata(src['meta']), metadata)
+        self.assertIsNot(pandocxnos.get_metadata({}), metadata)
+
+        # Make the comparisons
+        for name in ['xnos-cleveref-fake', 'xnos-number-sections', 'foo']:
+            self.assertTrue(name in metadata)
+            self.assertEqual(metadata[name], get_meta(src['meta'], name))
+        self.assertFalse('xnos-foo' in metadata)
+        self.assertTrue(metadata.isset('xnos-number-sections'))
+        self.assertFalse(metadata.isset('xnos-cleveref-fake'))
+        self.assertFalse(metadata.isset('xnos-foo'))
+
+        # The errors are the same as for get_meta()
+        self.assertRaises(RuntimeError, metadata.__getitem__, 'baz')
+        self.assertRaises(AssertionError, metadata.__getitem__, 'xnos-foo')
+
+
     def test_elt(self):
         """Tests elt()."""
 
@@ -141,6 +386,18 @@ class TestXnos(unittest.TestCase):
         self.assertEqual(el.__closure__[0].cell_contents, 'RawBlock')
         self.assertEqual(el.__closure__[1].cell_contents, 2)
 
+        # The constructors are made once
+        self.assertIs(elt('RawBlock', 2), el)
+
+        # The elements are the same as made by pandocfilters (but with lists
+        # instead of tuples)
+        for eltType, numargs in [('Para', 1), ('RawBlock', 2), ('Header', 3),
+                                 ('HorizontalRule', 0), ('Foo', 4)]:
+            args = [[str(i)] for i in range(numargs)]
+            self.assertEqual(elt(eltType, numargs)(*args),
+                             pandocfilters.elt(eltType, numargs)(*args))
+            self.assertRaises(ValueError, elt(eltType, numargs), *(args+[1]))
+
 
     def test_quotify_1(self):
         """Tests quotify() #1."""
@@ -264,6 +521,43 @@ class TestXnos(unittest.TestCase):
         self.assertEqual(extract_attrs(src['blocks'][0]['c'], 2), expected)
 
 
+    def test_extract_attrs_3(self):
+        """Tests extract_attrs() #3."""
+
+        # Compare against the pandoc-xnos 1.0 implementation for random
+        # sequences of elements
+        words = ['{', '}', '{#fig:1', '#eq:a', '.cls', '-', 'k=v', 'k="a b"',
+                 "k='x'", 'tag=', '"', "'", '=', 'a', '}.', 'b=1}']
+        def make_element(depth):
+            """Returns a random element."""
+            r = rng.random()
+            if r < 0.5 or depth == 2:
+                return Str(''.join(rng.choice(words) for _ in range(2)))
+            elif r < 0.7:
+                return Space()
+            elif r < 0.8:
+                return Math({"t":"InlineMath", "c":[]}, 'x^2')
+            elif r < 0.9:
+                quote = rng.choice(['DoubleQuote', 'SingleQuote'])
+                return Quoted({"t":quote, "c":[]},
+                              [make_element(depth+1) for _ in range(2)])
+            else:
+                return Emph([make_element(depth+1)])
+
+        rng = random.Random(0)
+        for _ in range(2000):
+            src = [Str('Test'), Str('{' + rng.choice(words))] + \
+              [make_element(0) for _ in range(rng.randint(0, 8))]
+            x1, x2 = copy.deepcopy(src), copy.deepcopy(src)
+            try:
+                expected = _extract_attrs_1p0(x1, 1)
+            except (ValueError, IndexError) as e:
+                self.assertRaises(type(e), extract_attrs, x2, 1)
+                continue
+            self.assertEqual(extract_attrs(x2, 1), expected)
+            self.assertEqual(x2, x1)
+
+
     # NOTE: Broken refs are fixed with pandoc 1.18
     def test_repair_refs_1(self):
         """Tests repair_refs() #1."""
@@ -407,6 +701,67 @@ class TestXnos(unittest.TestCase):
         pandocxnos.init(PANDOCVERSION)
 
 
+    def test_repair_refs_9(self):
+        """Tests repair_refs() #9."""
+
+        # Compare against the pandoc-xnos 1.0 implementation for random
+        # sequences of elements
+        texts = ['{', '}', '{@fig', '@fig', '+@fig', '{*@eq', ':', ':1',
+                 ':1}', ':a}-{', '1}-{@fig', 'x', '}-{', '!']
+        def make_element():
+            """Returns a random element."""
+            r = rng.random()
+            if r < 0.4:
+                return Str(''.join(rng.choice(texts) for _ in range(2)))
+            elif r < 0.8:
+                return Link(['', [], []], [Str(rng.choice(texts))],
+                            ['mailto:x', ''])
+            elif r < 0.9:
+                return Space()
+            else:
+                return Link(['', [], []],
+                            [Quoted({"t":"DoubleQuote", "c":[]},
+                                    [Str('@fig')])], ['mailto:x', ''])
+
+        pandocxnos.init('1.17.2')
+        try:
+            rng = random.Random(0)
+            for _ in range(2000):
+                src = [make_element() for _ in range(rng.randint(0, 10))]
+                expected = _repair_refs_1p0(copy.deepcopy(src))
+                self.assertEqual(walk([Para(src)], repair_refs, {}, ''),
+                                 [Para(expected)])
+        finally:
+            pandocxnos.init(PANDOCVERSION)
+
+
+    def test_repair_refs_10(self):
+        """Tests repair_refs() #10."""
+
+        ## test.md: {@fig:1}-{@fig:3} ##
+
+        # Command: pandoc-1.17.2 test.md -f markdown+autolink_bare_uris -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Link","c":[["",[],[]],[{"t":"Str","c":"{@fig"}],["mailto:%7B@fig",""]]},{"t":"Str","c":":"},{"t":"Link","c":[["",[],[]],[{"t":"Str","c":"1}-{@fig"}],["mailto:1%7D-%7B@fig",""]]},{"t":"Str","c":":3}"}]}]]''')
+
+        # Command: pandoc test.md -t json
+        expected = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}-{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:3","citationHash":0}],[{"t":"Str","c":"@fig:3"}]]},{"t":"Str","c":"}"}]}]]''')
+
+        # Stress test: a paragraph with 10000 copies of the above, in which
+        # one repair completes another
+        n = 10000
+        x = json.loads(json.dumps(
+            (src[1][0]['c'] + [Space()])*n))
+        expected = json.loads(json.dumps(
+            (expected[1][0]['c'] + [Space()])*n))
+
+        pandocxnos.init('1.17.2')
+        try:
+            self.assertEqual(walk([Para(x)], repair_refs, {}, ''),
+                             [Para(expected)])
+        finally:
+            pandocxnos.init(PANDOCVERSION)
+
+
     def test_process_refs_factory_1(self):
         """Tests process_refs_factory() #1."""
 
@@ -621,6 +976,106 @@ class TestXnos(unittest.TestCase):
         self.assertEqual(walk(src, process_refs, {}, ''), expected)
 
 
+    def test_process_refs_factory_10(self):
+        """Tests process_refs_factory() #10."""
+
+        ## test.md: "{+@fig:1}{@fig:1} " repeated 1000 times ##
+
+        # Hand-coded (one repetition)
+        src = r'''{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]}'''
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[%s]}]]''' % \
+                   ','.join([src]*1000))
+
+        # Hand-coded (braces stripped, modifiers extracted, attributes added)
+        expected = r'''{"t":"Cite","c":[["",[],[["modifier","+"]]],[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Cite","c":[["",[],[]],[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Space","c":[]}'''
+        expected = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[%s]}]]''' % \
+                        ','.join([expected]*1000))
+
+        # Make the comparison
+        process_refs = process_refs_factory(['fig:1'])
+        self.assertEqual(walk(src, process_refs, {}, ''), expected)
+
+
+    def test_process_refs_factory_11(self):
+        """Tests process_refs_factory() #11."""
+
+        ## test.md: {+@fig:1} and {@fig:2}. ##
+
+        # Command: pandoc-1.15.2 test.md -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]},{"t":"Str","c":"and"},{"t":"Space","c":[]},{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:2","citationHash":0}],[{"t":"Str","c":"@fig:2"}]]},{"t":"Str","c":"}."}]}]]''')
+
+        # Only fig:1 is known when the first walk is made; fig:2 is added to
+        # the list before the second
+        labels = ['fig:0', 'fig:1']
+        process_refs = process_refs_factory(labels)
+        output = walk(src, process_refs, '', {})
+        self.assertEqual(output[1][0]['c'][0]['c'][0],
+                         ['', [], [['modifier', '+']]])
+        self.assertEqual(len(output[1][0]['c'][5]['c']), 2)
+
+        labels.append('fig:2')
+        output = walk(output, process_refs, '', {})
+        self.assertEqual(output[1][0]['c'][4]['c'][0], ['', [], []])
+
+
+    def test_process_refs_factory_12(self):
+        """Tests process_refs_factory() #12."""
+
+        ## test.md ##
+        #
+        # | a |
+        # |---|
+        #
+        # Table: See {+@fig:1}.
+
+        # Command: pandoc-2.19.2 test.md -t json
+        src = eval(r'''{"pandoc-api-version":[1,22,2,1],"meta":{},"blocks":[{"t":"Table","c":[["",[],[]],[None,[{"t":"Plain","c":[{"t":"Str","c":"See"},{"t":"Space"},{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationId":"fig:1","citationPrefix":[],"citationSuffix":[],"citationMode":{"t":"AuthorInText"},"citationNoteNum":1,"citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}."}]}]],[[{"t":"AlignDefault"},{"t":"ColWidthDefault"}]],[["",[],[]],[]],[[["",[],[]],0,[],[[["",[],[]],[[["",[],[]],{"t":"AlignDefault"},1,1,[{"t":"Plain","c":[{"t":"Str","c":"a"}]}]]]]]]],[["",[],[]],[]]]}]}''')
+
+        # Hand-coded (the caption)
+        expected = eval(r'''[None,[{"t":"Plain","c":[{"t":"Str","c":"See"},{"t":"Space"},{"t":"Cite","c":[["",[],[["modifier","+"]]],[{"citationId":"fig:1","citationPrefix":[],"citationSuffix":[],"citationMode":{"t":"AuthorInText"},"citationNoteNum":1,"citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"."}]}]]''')
+
+        # The caption holds blocks rather than inlines
+        try:
+            pandocxnos.init(doc=src)
+            output = walk(src, process_refs_factory(['fig:1']), '', {})
+            self.assertEqual(output['blocks'][0]['c'][1], expected)
+        finally:
+            pandocxnos.init(PANDOCVERSION)
+
+
+    def test_label_registry(self):
+        """Tests LabelRegistry."""
+
+        registry = pandocxnos.LabelRegistry()
+        self.assertEqual(registry.add('fig:1'), 1)
+        self.assertEqual(registry.add('fig:tagged', 'B.1'), 'B.1')
+        self.assertEqual(registry.add('fig:2'), 2)
+        self.assertEqual(list(registry), ['fig:1', 'fig:tagged', 'fig:2'])
+        self.assertEqual(registry['fig:2'], 2)
+
+        ## test.md: {+@fig:1} and {@fig:2}. ##
+
+        # Command: pandoc-1.15.2 test.md -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]},{"t":"Str","c":"and"},{"t":"Space","c":[]},{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:2","citationHash":0}],[{"t":"Str","c":"@fig:2"}]]},{"t":"Str","c":"}."}]}]]''')
+
+        # Compare against using a list and dict
+        for fmt in ['latex', 'html']:
+            outputs = []
+            for labels, references in [(['fig:1', 'fig:tagged', 'fig:2'],
+                                        {'fig:1':1, 'fig:tagged':'B.1',
+                                         'fig:2':2}),
+                                       (registry, registry)]:
+                actions = [process_refs_factory(labels),
+                           replace_refs_factory(references, False,
+                                                ['fig.', 'figs.'],
+                                                ['Figure', 'Figures'],
+                                                'figure')]
+                pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+                outputs.append(walk_actions(copy.deepcopy(src[1]), actions,
+                                            fmt, {}))
+            self.assertEqual(outputs[0], outputs[1])
+
+
     def test_replace_refs_factory(self):
         """Tests replace_refs_factory."""
 
@@ -641,6 +1096,61 @@ class TestXnos(unittest.TestCase):
                               join_strings, {}, ''), expected)
 
 
+    def test_replace_refs_factory_2(self):
+        """Tests replace_refs_factory #2."""
+
+        # Hand-coded (two processed references to the same figure)
+        src = eval(r'''[{"t":"Para","c":[{"t":"Cite","c":[["",[],[["modifier","+"]]],[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Space","c":[]},{"t":"Cite","c":[["",[],[["modifier","+"]]],[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]}]}]''')
+
+        # Hand-coded
+        expected = eval(r'''[{"t":"Para","c":[{"t":"Str","c":"fig."},{"t":"Space","c":[]},{"t":"Link","c":[["",[],[]],[{"t":"Str","c":"1"}],["#fig:1",""]]},{"t":"Space","c":[]},{"t":"Str","c":"fig."},{"t":"Space","c":[]},{"t":"Link","c":[["",[],[]],[{"t":"Str","c":"1"}],["#fig:1",""]]}]}]''')
+
+        # Make the comparison
+        replace_refs = replace_refs_factory({'fig:1':1}, False,
+                                            ['fig.', 'figs.'],
+                                            ['Figure', 'Figures'],
+                                            'figure')
+        output = walk(src, replace_refs, 'html', {})
+        self.assertEqual(output, expected)
+
+        # The replacements must not share elements
+        self.assertIsNot(output[0]['c'][0], output[0]['c'][4])
+        self.assertIsNot(output[0]['c'][2]['c'][1],
+                         output[0]['c'][6]['c'][1])
+
+
+    def test_replace_refs_factory_3(self):
+        """Tests replace_refs_factory #3."""
+
+        # Hand-coded (a processed reference to a figure)
+        src = eval(r'''[{"t":"Para","c":[{"t":"Cite","c":[["",[],[["modifier","+"]]],[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]}]}]''')
+
+        references = {'fig:1':1}
+        plusname = ['fig.', 'figs.']
+        pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+        replace_refs = replace_refs_factory(references, False, plusname,
+                                            ['Figure', 'Figures'], 'figure')
+
+        def replace(fmt, meta):
+            """Returns the replacement for the reference."""
+            return walk(copy.deepcopy(src), replace_refs, fmt, meta)[0]['c']
+
+        # The replacements follow changes to the references and names
+        self.assertEqual(stringify(replace('html', {})), 'fig. 1')
+        references['fig:1'] = 2
+        plusname[0] = 'Fig.'
+        self.assertEqual(stringify(replace('html', {})), 'Fig. 2')
+
+        # ... and to the metadata
+        meta = {'xnos-cleveref-fake':{'t':'MetaBool', 'c':False}}
+        self.assertEqual(replace('latex', meta)[0]['c'][1], r'\cref{fig:1}')
+        self.assertEqual(replace('latex', {})[0]['c'][1],
+                         r'\xrefname{Fig.}\cref{fig:1}')
+
+        # Formats that aren't strings don't need to be hashable
+        self.assertEqual(stringify(replace({}, {})), 'Fig. 2')
+
+
     def test_attach_attrs_factory(self):
         """Tests attach_attrs_math()."""
 
@@ -689,6 +1199,501 @@ class TestXnos(unittest.TestCase):
         self.assertEqual(walk(src, detach_attrs_math, '', {}), expected)
 
 
+    def test_insert_rawblocks_factory(self):
+        """Tests insert_rawblocks_factory()."""
+
+        # Hand-coded
+        src = eval(r'''{"meta":{},"blocks":[{"t":"RawBlock","c":["tex","\\a"]},{"t":"RawBlock","c":["tex","\\b"]},{"t":"Para","c":[{"t":"Str","c":"foo"}]},{"t":"RawBlock","c":["tex","\\c"]}],"pandoc-api-version":[1,17,0,4]}''')
+
+        # Hand-coded
+        expected = eval(r'''{"meta":{},"blocks":[{"t":"RawBlock","c":["tex","\\a"]},{"t":"RawBlock","c":["tex","\\c"]},{"t":"RawBlock","c":["tex","\\b"]},{"t":"Para","c":[{"t":"Str","c":"foo"}]},{"t":"RawBlock","c":["tex","\\c"]}],"pandoc-api-version":[1,17,0,4]}''')
+
+        # The duplicate \a isn't inserted, and \c is inserted before \b
+        rawblocks = [RawBlock('tex', r'\a'), RawBlock('tex', r'\c')]
+        insert_rawblocks = insert_rawblocks_factory(rawblocks)
+        self.assertEqual(walk(src, insert_rawblocks, 'latex', {}), expected)
+        self.assertEqual(rawblocks, [])
+
+        # The blocks are placed once
+        self.assertEqual(walk(src, insert_rawblocks, 'latex', {}), src)
+
+
+    def test_insert_rawblocks_factory_2(self):
+        """Tests insert_rawblocks_factory() #2."""
+
+        # Hand-coded
+        src = eval(r'''{"meta":{},"blocks":[{"t":"RawBlock","c":["tex","\\a"]},{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4]}''')
+
+        # Hand-coded
+        expected = eval(r'''{"meta":{},"blocks":[{"t":"RawBlock","c":["tex","\\a"]},{"t":"RawBlock","c":["tex","\\b"]},{"t":"RawBlock","c":["tex","\\a"]},{"t":"RawBlock","c":["tex","\\b"]},{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4]}''')
+
+        # Blocks appended after the factory is called are inserted, and only
+        # one of the pending \a blocks is a duplicate
+        rawblocks = [RawBlock('tex', r'\b')]
+        insert_rawblocks = insert_rawblocks_factory(rawblocks)
+        rawblocks.extend([RawBlock('tex', r'\a'), RawBlock('tex', r'\a'),
+                          RawBlock('tex', r'\b')])
+        self.assertEqual(walk(src, insert_rawblocks, 'latex', {}), expected)
+        self.assertEqual(rawblocks, [])
+
+
+    def test_load_doc(self):
+        """Tests load_doc()."""
+
+        # Hand-coded
+        src = br'''{"pandoc-api-version":[1,17],"meta":{},"blocks":[{"t":"Para","c":[{"t":"Str","c":"\u00e9\ud800"},{"t":"Str","c":"1.5e300"}]}]}'''
+
+        expected = json.loads(src.decode('utf-8'))
+
+        environ = os.environ.copy()
+        try:
+            for backend in ['json', 'fast']:
+                os.environ['XNOS_JSON'] = backend
+                pandocxnos.core._LOADS = None  # pylint: disable=protected-access
+                self.assertEqual(pandocxnos.load_doc(io.BytesIO(src)),
+                                 expected)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            pandocxnos.core._LOADS = None  # pylint: disable=protected-access
+
+
+    def test_dump_doc(self):
+        """Tests dump_doc()."""
+
+        # Hand-coded
+        src = eval(r'''{"pandoc-api-version":[1,17],"meta":{},"blocks":[{"t":"Para","c":[{"t":"Str","c":u"\u00e9"},{"t":"Math","c":[{"t":"InlineMath","c":[]},"x/2"]}]}]}''')
+
+        stream = io.BytesIO()
+        pandocxnos.dump_doc(src, stream)
+        self.assertEqual(stream.getvalue(), json.dumps(src).encode('utf-8'))
+
+
+    def test_walk_actions_1(self):
+        """Tests walk_actions() #1."""
+
+        ## test.md: {+@fig:1} and {@fig:2}. ##
+
+        # Command: pandoc-1.15.2 test.md -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]},{"t":"Str","c":"and"},{"t":"Space","c":[]},{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:2","citationHash":0}],[{"t":"Str","c":"@fig:2"}]]},{"t":"Str","c":"}."}]}]]''')
+
+        # Compare against a series of walks
+        for fmt in ['latex', 'html']:
+            actions = [
+                repair_refs, process_refs_factory(['fig:1', 'fig:2']),
+                replace_refs_factory({'fig:1':1, 'fig:2':2}, False,
+                                     ['fig.', 'figs.'],
+                                     ['Figure', 'Figures'], 'figure'),
+                join_strings]
+            pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+            expected = functools.reduce(
+                lambda x, action: walk(x, action, fmt, {}), actions,  # pylint: disable=cell-var-from-loop
+                copy.deepcopy(src[1]))
+            pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+            self.assertEqual(walk_actions(copy.deepcopy(src[1]), actions,
+                                          fmt, {}), expected)
+
+
+    def test_walk_actions_2(self):
+        """Tests walk_actions() #2."""
+
+        src = eval(r'''[{"t":"Para","c":[{"t":"Str","c":"foo"}]},{"t":"Plain","c":[{"t":"Emph","c":[{"t":"Str","c":"bar"}]}]}]''')
+
+        keys = []
+
+        @acts_on('Para', 'Emph')
+        def action(key, value, fmt, meta):  # pylint: disable=unused-argument
+            """Records the keys."""
+            keys.append(key)
+
+        walk_actions(src, [action], '', {})
+        self.assertEqual(keys, ['Para', 'Emph'])
+
+
+    def test_walk_actions_3(self):
+        """Tests walk_actions() #3."""
+
+        src = eval(r'''[{"t":"Para","c":[{"t":"Str","c":"foo"}]},{"t":"Para","c":[{"t":"Str","c":"bar"}]}]''')
+
+        calls = []
+
+        @acts_on('Para')
+        def action1(key, value, fmt, meta):  # pylint: disable=unused-argument
+            """Records the calls."""
+            calls.append((1, value[0]['c']))
+
+        @acts_on('Para', newpass=True)
+        def action2(key, value, fmt, meta):  # pylint: disable=unused-argument
+            """Records the calls."""
+            calls.append((2, value[0]['c']))
+
+        @acts_on('Para')
+        def action3(key, value, fmt, meta):  # pylint: disable=unused-argument
+            """Records the calls."""
+            calls.append((3, value[0]['c']))
+
+        walk_actions(src, [action1, action2, action3], '', {})
+        self.assertEqual(calls, [(1, 'foo'), (1, 'bar'), (2, 'foo'),
+                                 (3, 'foo'), (2, 'bar'), (3, 'bar')])
+
+
+    @unittest.skipIf(os.name == 'nt', 'Needs the fork start method')
+    def test_walk_actions_4(self):
+        """Tests walk_actions() #4."""
+
+        ## test.md: {+@fig:1} and {@fig:2}. ##
+
+        # Command: pandoc-1.15.2 test.md -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]},{"t":"Str","c":"and"},{"t":"Space","c":[]},{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:2","citationHash":0}],[{"t":"Str","c":"@fig:2"}]]},{"t":"Str","c":"}."}]}]]''')
+        src = json.loads(json.dumps(src[1]*200))  # No shared elements
+
+        # Compare processing in parallel against processing in this process
+        for fmt in ['latex', 'html']:
+            outputs = []
+            for processes in [1, 2]:
+                actions = [
+                    repair_refs, process_refs_factory(['fig:1', 'fig:2']),
+                    join_strings,
+                    replace_refs_factory({'fig:1':1, 'fig:2':2}, False,
+                                         ['fig.', 'figs.'],
+                                         ['Figure', 'Figures'], 'figure'),
+                    join_strings]
+                pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+                outputs.append(walk_actions(copy.deepcopy(src), actions, fmt,
+                                            {}, processes))
+            self.assertEqual(outputs[0], outputs[1])
+
+            # The cleveref TeX must be found by the parallel processing
+            if fmt == 'latex':
+                self.assertEqual(outputs[1][0]['t'], 'RawBlock')
+
+        # A bad XNOS_PROCESSES value falls back to one process
+        environ = os.environ.copy()
+        stderr = pandocxnos.core.STDERR
+        try:
+            os.environ['XNOS_PROCESSES'] = 'auto'
+            pandocxnos.core.STDERR = io.StringIO()
+            self.assertEqual(walk_actions(copy.deepcopy(src), [join_strings],
+                                          'html', {}),
+                             walk_actions(copy.deepcopy(src), [join_strings],
+                                          'html', {}, 1))
+            self.assertIn('XNOS_PROCESSES=auto',
+                          pandocxnos.core.STDERR.getvalue())
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            pandocxnos.core.STDERR = stderr
+
+
+    def test_walk_actions_5(self):
+        """Tests walk_actions() #5."""
+
+        ## test.md: {+@fig:1} and {@fig:2}. ##
+
+        # Command: pandoc-1.15.2 test.md -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]},{"t":"Str","c":"and"},{"t":"Space","c":[]},{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:2","citationHash":0}],[{"t":"Str","c":"@fig:2"}]]},{"t":"Str","c":"}."}]}]]''')
+
+        def get_actions(labels):
+            """Returns the actions."""
+            return [repair_refs, process_refs_factory(labels), join_strings,
+                    replace_refs_factory({'fig:1':1, 'fig:2':2}, False,
+                                         ['fig.', 'figs.'],
+                                         ['Figure', 'Figures'], 'figure')]
+
+        path = tempfile.mkdtemp()
+        try:
+            # Compare processing with a cache against processing without one
+            for fmt in ['latex', 'html']:
+                cache = BlockCache(path=os.path.join(path, fmt))
+                pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+                expected = walk_actions(copy.deepcopy(src[1]),
+                                        get_actions(['fig:1', 'fig:2']),
+                                        fmt, {})
+                for hits in [0, 1]:
+                    pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+                    output = walk_actions(copy.deepcopy(src[1]),
+                                          get_actions(['fig:1', 'fig:2']),
+                                          fmt, {}, cache=cache)
+                    self.assertEqual(output, expected)
+                    self.assertEqual(cache.hits, hits)
+
+                # The cleveref TeX must be found in the cache
+                if fmt == 'latex':
+                    self.assertEqual(output[0]['t'], 'RawBlock')
+
+                # Changes to the labels, metadata or context are misses
+                for labels, meta, context in \
+                  [(['fig:1'], {}, None), (['fig:1', 'fig:2'], {'a':1}, None),
+                   (['fig:1', 'fig:2'], {}, {'fig:1':2})]:
+                    cache.context = context
+                    walk_actions(copy.deepcopy(src[1]), get_actions(labels),
+                                 fmt, meta, cache=cache)
+                    self.assertEqual(cache.hits, 1)
+
+                # Only the changed items of an edited list are misses
+                cache.context = None
+                x = copy.deepcopy(src[1]) + [Para([Str('new')])]
+                walk_actions(x, get_actions(['fig:1', 'fig:2']), fmt, {},
+                             cache=cache)
+                self.assertEqual((cache.hits, cache.misses), (2, 5))
+
+            # The cache is only pruned after enough has been written
+            def count():
+                """Returns the number of files in the html cache."""
+                return len([filename for filename in
+                            os.listdir(os.path.join(path, 'html'))
+                            if filename.endswith('.json')])
+            n = count()
+            cache.maxsize = 8*n*1024
+            cache.written = 1
+            cache.tidy()
+            self.assertEqual(count(), n)
+            self.assertTrue(os.path.exists(os.path.join(path, 'html',
+                                                        'written')))
+
+            # Entries are evicted once the cache is too big
+            cache.maxsize = 0
+            cache.written = 1
+            cache.tidy()
+            self.assertEqual(count(), 0)
+            self.assertFalse(os.path.exists(os.path.join(path, 'html',
+                                                         'written')))
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_walk_actions_6(self):
+        """Tests walk_actions() #6."""
+
+        src = eval(r'''[{"t":"Para","c":[{"t":"Str","c":"foo"}]},{"t":"Para","c":[{"t":"Str","c":"bar"}]},{"t":"Para","c":[{"t":"Str","c":"baz"}]}]''')
+
+        calls = []
+
+        @acts_on('Para', 'Str')
+        def action1(key, value, fmt, meta):  # pylint: disable=unused-argument
+            """Records the calls."""
+            calls.append((1, key))
+
+        # Acts on Str elements after the first Para, and is finished after
+        # the second
+        action1.status = lambda fmt, meta: \
+          [None, frozenset(['Str']), frozenset()][min(len(calls)//2, 2)]
+
+        @acts_on('Para')
+        def action2(key, value, fmt, meta):  # pylint: disable=unused-argument
+            """Records the calls."""
+            calls.append((2, key))
+
+        expected = [(1, 'Para'), (1, 'Str'), (2, 'Para'), (1, 'Str'),
+                    (2, 'Para'), (2, 'Para')]
+
+        walk_actions(copy.deepcopy(src), [action1, action2], '', {})
+        self.assertEqual(calls, expected)
+
+        # Also when filtering a stream
+        del calls[:]
+        filter_stream(lambda doc: [action1, action2], '',
+                      io.StringIO(u'%s' % json.dumps([{'unMeta':{}}, src])),
+                      io.StringIO())
+        self.assertEqual(calls, expected)
+
+
+    def test_profile(self):
+        """Tests profiling."""
+
+        # Hand-coded
+        src = eval(r'''[{"t":"Para","c":[{"t":"Str","c":"foo"},{"t":"Str","c":"bar"},{"t":"Str","c":"baz"}]}]''')
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # Profile a filter in a process of its own
+            filename = os.path.join(tmpdir, 'profile.json')
+            code = 'import pandocxnos; pandocxnos.init("1.17")\n' \
+              'n = [0]\n' \
+              '@pandocxnos.core._repeat\n' \
+              'def again(*args):\n' \
+              '    n[0] += 1\n' \
+              '    return True if n[0] > 2 else None\n' \
+              'pandocxnos.walk_actions(%s, [pandocxnos.repair_refs, ' \
+              'pandocxnos.join_strings, again], "", {})' % repr(src)
+            environ = dict(os.environ, XNOS_PROFILE=filename)
+            for _ in range(2):
+                subprocess.check_call([sys.executable, '-c', code],
+                                      env=environ)
+
+            # Each run appends a line
+            with open(filename) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), 2)
+
+            stats = lines[0]['stats']
+            self.assertEqual(stats['join_strings']['calls'], 1)
+            self.assertEqual(stats['join_strings']['replaced'], 0)
+            self.assertEqual(stats['join_strings']['restarts'], 0)
+            self.assertEqual(stats['repair_refs']['restarts'], 0)
+
+            # Only a scan that goes back to the beginning is a restart
+            self.assertEqual(stats['__main__.again']['restarts'], 2)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_document_context(self):
+        """Tests DocumentContext."""
+
+        ## test.md ##
+        #
+        # | a |
+        # |---|
+        #
+        # Table: See {+@fig:1}.
+
+        # Command: pandoc-2.19.2 test.md -t json
+        src = eval(r'''{"pandoc-api-version":[1,22,2,1],"meta":{},"blocks":[{"t":"Table","c":[["",[],[]],[None,[{"t":"Plain","c":[{"t":"Str","c":"See"},{"t":"Space"},{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationId":"fig:1","citationPrefix":[],"citationSuffix":[],"citationMode":{"t":"AuthorInText"},"citationNoteNum":1,"citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}."}]}]],[[{"t":"AlignDefault"},{"t":"ColWidthDefault"}]],[["",[],[]],[]],[[["",[],[]],0,[],[[["",[],[]],[[["",[],[]],{"t":"AlignDefault"},1,1,[{"t":"Plain","c":[{"t":"Str","c":"a"}]}]]]]]]],[["",[],[]],[]]]}]}''')
+
+        # Hand-coded (the caption)
+        expected = eval(r'''[None,[{"t":"Plain","c":[{"t":"Str","c":"See"},{"t":"Space"},{"t":"Cite","c":[["",[],[["modifier","+"]]],[{"citationId":"fig:1","citationPrefix":[],"citationSuffix":[],"citationMode":{"t":"AuthorInText"},"citationNoteNum":1,"citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"."}]}]]''')
+
+        # The state is kept in the context and not the globals
+        # pylint: disable=protected-access
+        pandocxnos.core._CLEVEREFTEX = False
+        context = pandocxnos.DocumentContext()
+        self.assertEqual(pandocxnos.init(doc=src, context=context), '2.10')
+        self.assertEqual(pandocxnos.core._PANDOCVERSION, PANDOCVERSION)
+        output = walk_actions(src, [context.repair_refs, context.join_strings,
+                                    process_refs_factory(['fig:1'], context)],
+                              '', {}, context=context)
+        self.assertEqual(output['blocks'][0]['c'][1], expected)
+        self.assertTrue(context.clevereftex)
+        self.assertFalse(pandocxnos.core._CLEVEREFTEX)
+
+        # The default context's actions are the module's
+        self.assertIsNot(context.join_strings, join_strings)
+        self.assertIs(pandocxnos.core._DEFAULT_CONTEXT.join_strings,
+                      join_strings)
+
+        # Hand-coded
+        src = eval(r'''[{"t":"Header","c":[1,["",[],[]],[{"t":"Str","c":"A"}]]},{"t":"Header","c":[2,["",[],[]],[{"t":"Str","c":"B"}]]},{"t":"Para","c":[{"t":"Image","c":[["fig:1",[],[]],[],["a.png",""]]}]}]''')
+
+        meta = {'xnos-number-sections': {'t':'MetaBool', 'c':True}}
+        context.maxlevel = 2
+        sec = list(pandocxnos.core.SEC)
+        insert_secnos = pandocxnos.insert_secnos_factory(elt('Image', 3),
+                                                         context)
+        walk_actions(src, [insert_secnos], 'html', meta, context=context)
+        self.assertEqual(src[2]['c'][0]['c'][0][2], [['secno', '1.1']])
+        self.assertEqual(context.sec, [1, 1])
+        self.assertEqual(pandocxnos.core.SEC, sec)
+
+        # The metadata is kept in the context
+        self.assertIs(context.metadata.meta, meta)
+        self.assertIsNot(pandocxnos.core._METADATA, context.metadata)
+
+        # Documents filtered in threads get their own metadata, even from the
+        # default context
+        errors = []
+        def check(meta):
+            """Checks the metadata given for 'meta'."""
+            for _ in range(10000):
+                if pandocxnos.get_metadata(meta).meta is not meta:
+                    errors.append(meta)
+        threads = [threading.Thread(target=check, args=({'n':n},))
+                   for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+    def test_document_context_2(self):
+        """Tests DocumentContext #2."""
+
+        # Hand-coded
+        src = eval(r'''[{"t":"Header","c":[1,["",[],[]],[{"t":"Str","c":"A"}]]},{"t":"Para","c":[{"t":"Image","c":[["fig:1",[],[]],[],["a.png",""]]}]}]''')
+
+        # Documents with and without section numbers are filtered side by
+        # side, each in a context of its own
+        # pylint: disable=protected-access
+        metadata = pandocxnos.core._METADATA
+        contexts = [pandocxnos.DocumentContext() for _ in range(2)]
+        metas = [{'xnos-number-sections': {'t':'MetaBool', 'c':flag}}
+                 for flag in [True, False]]
+        docs = [copy.deepcopy(src) for _ in range(2)]
+        actions = [[pandocxnos.insert_secnos_factory(elt('Image', 3),
+                                                     context),
+                    pandocxnos.delete_secnos_factory(elt('Image', 3),
+                                                     context)]
+                   for context in contexts]
+        for i in [0, 1]:
+            walk_actions(docs[i], actions[i][:1], 'html', metas[i],
+                         context=contexts[i])
+        self.assertEqual(docs[0][1]['c'][0]['c'][0][2], [['secno', '1']])
+        self.assertEqual(docs[1][1]['c'][0]['c'][0][2], [])
+        for i in [0, 1]:
+            walk_actions(docs[i], actions[i][1:], 'html', metas[i],
+                         context=contexts[i])
+        self.assertEqual(docs[0][1]['c'][0]['c'][0][2], [])
+
+        # The metadata is kept in each context
+        for context, meta in zip(contexts, metas):
+            self.assertIs(context.metadata.meta, meta)
+        self.assertIs(pandocxnos.core._METADATA, metadata)
+
+
+    def test_filter_stream_1(self):
+        """Tests filter_stream() #1."""
+
+        ## test.md: {+@fig:1} and {@fig:2}. ##
+
+        # Command: pandoc-1.15.2 test.md -t json
+        src = eval(r'''[{"unMeta":{}},[{"t":"Para","c":[{"t":"Str","c":"{+"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:1","citationHash":0}],[{"t":"Str","c":"@fig:1"}]]},{"t":"Str","c":"}"},{"t":"Space","c":[]},{"t":"Str","c":"and"},{"t":"Space","c":[]},{"t":"Str","c":"{"},{"t":"Cite","c":[[{"citationSuffix":[],"citationNoteNum":0,"citationMode":{"t":"AuthorInText","c":[]},"citationPrefix":[],"citationId":"fig:2","citationHash":0}],[{"t":"Str","c":"@fig:2"}]]},{"t":"Str","c":"}."}]}]]''')
+
+        def get_actions(doc):  # pylint: disable=unused-argument
+            """Returns the actions."""
+            return [repair_refs, process_refs_factory(['fig:1', 'fig:2']),
+                    replace_refs_factory({'fig:1':1, 'fig:2':2}, False,
+                                         ['fig.', 'figs.'],
+                                         ['Figure', 'Figures'], 'figure'),
+                    join_strings]
+
+        # Both the pandoc 1.17 and 1.18 document layouts are checked
+        docs = [src, {'pandoc-api-version':[1, 17], 'meta':src[0]['unMeta'],
+                      'blocks':src[1]}]
+
+        for fmt, doc in itertools.product(['latex', 'html'], docs):
+
+            # Compare against walk_actions()
+            expected = copy.deepcopy(doc)
+            pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+            walk_actions(expected['blocks'] if 'blocks' in expected else \
+                         expected[1], get_actions(expected), fmt, {})
+
+            # Pass the document a few characters at a time
+            instream = _Trickle(u'%s' % json.dumps(doc, indent=2), 5)
+            outstream = io.StringIO()
+
+            pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+            filter_stream(get_actions, fmt, instream, outstream)
+            self.assertEqual(outstream.getvalue(), json.dumps(expected))
+
+
+    def test_filter_stream_2(self):
+        """Tests filter_stream() #2."""
+
+        # Hand-coded (the blocks come before the metadata)
+        src = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"},{"t":"Str","c":"bar"}]}],"meta":{},"pandoc-api-version":[1,17]}''')
+
+        # Hand-coded
+        expected = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foobar"}]}],"meta":{},"pandoc-api-version":[1,17]}''')
+
+        outstream = io.StringIO()
+        filter_stream(lambda doc: [join_strings], '',
+                      io.StringIO(u'%s' % json.dumps(src)), outstream)
+        self.assertEqual(json.loads(outstream.getvalue()), expected)
+
+
 # pylint: disable=too-few-public-methods
 class TestPandocAttributes(unittest.TestCase):
     """Test the pandocattributes package."""
@@ -703,6 +1708,378 @@ class TestPandocAttributes(unittest.TestCase):
         self.assertEqual(attrs['tag'], 'B.3')
 
 
+class TestHost(unittest.TestCase):
+    """Test the pandocxnos.host module."""
+
+    def test_run_plugins(self):
+        """Tests run_plugins()."""
+
+        src = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # Hand-coded
+        expected = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"},{"t":"Str","c":"latex"},{"t":"Str","c":"!"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # A plugin that provides filter_doc()
+        plugin1 = types.ModuleType('plugin1')
+        def filter_doc(doc, fmt):
+            """Appends the format to the first block."""
+            # pylint: disable=protected-access
+            self.assertFalse(pandocxnos.core._CLEVEREFTEX)
+            pandocxnos.core._CLEVEREFTEX = True
+            doc['blocks'][0]['c'].append({'t':'Str', 'c':fmt})
+            return doc
+        plugin1.filter_doc = filter_doc
+
+        # A plugin that only provides main()
+        plugin2 = types.ModuleType('plugin2')
+        def main():
+            """Appends '!' to the first block."""
+            # pylint: disable=protected-access
+            self.assertFalse(pandocxnos.core._CLEVEREFTEX)
+            doc = json.loads(plugin2.STDIN.read())
+            doc['blocks'][0]['c'].append({'t':'Str', 'c':'!'})
+            json.dump(doc, plugin2.STDOUT)
+            plugin2.STDOUT.flush()
+        plugin2.main = main
+        plugin2.STDIN, plugin2.STDOUT = pandocxnos.STDIN, pandocxnos.STDOUT
+
+        # Make the comparison
+        text = json.dumps(src)
+        pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+        self.assertEqual(pandocxnos.host.run_plugins(src, 'latex',
+                                                     [plugin1, plugin2]),
+                         expected)
+        self.assertIs(plugin2.STDOUT, pandocxnos.STDOUT)
+
+        # The json text written by a plugin's main() is passed on as it is
+        def main3():
+            """Indents the json."""
+            json.dump(json.loads(plugin3.STDIN.read()), plugin3.STDOUT,
+                      indent=1)
+        plugin3 = types.ModuleType('plugin3')
+        plugin3.main = main3
+        plugin3.STDIN, plugin3.STDOUT = pandocxnos.STDIN, pandocxnos.STDOUT
+        output = pandocxnos.host.run_plugins(text, 'latex',
+                                             [plugin1, plugin2, plugin3])
+        self.assertEqual(output, json.dumps(expected, indent=1))
+        pandocxnos.core._CLEVEREFTEX = False  # pylint: disable=protected-access
+
+
+class TestServer(unittest.TestCase):
+    """Test the pandocxnos.server module."""
+
+    def test_request(self):
+        """Tests Server and request()."""
+
+        src = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # Hand-coded
+        expected = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"},{"t":"Str","c":"latex"},{"t":"Str","c":"bar"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # A plugin that appends the format and an environment variable, and
+        # alters the state kept by core.py
+        plugin = types.ModuleType('plugin')
+        def filter_doc(doc, fmt):
+            """Appends to the first block."""
+            # pylint: disable=protected-access
+            if pandocxnos.core._CLEVEREFTEX:
+                raise RuntimeError('State leaked between documents')
+            pandocxnos.core._CLEVEREFTEX = True
+            doc['blocks'][0]['c'].append({'t':'Str', 'c':fmt})
+            doc['blocks'][0]['c'].append({'t':'Str',
+                                          'c':os.environ['XNOS_TEST']})
+            return doc
+        plugin.filter_doc = filter_doc
+
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'xnos.sock')
+        server = pandocxnos.server.Server(path, [plugin])
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        environ = os.environ.copy()
+        try:
+            self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+            self.assertRaises(RuntimeError, pandocxnos.server.Server, path,
+                              [plugin])
+
+            # Each document starts from the same state
+            os.environ['XNOS_TEST'] = 'bar'
+            data = json.dumps(src).encode('utf-8')
+            for _ in range(2):
+                output = pandocxnos.server.request(path, ['latex'], data)
+                self.assertEqual(json.loads(output.decode('utf-8')),
+                                 expected)
+
+            # Errors are passed back
+            del os.environ['XNOS_TEST']
+            self.assertRaises(RuntimeError, pandocxnos.server.request, path,
+                              ['latex'], data)
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
+        # The socket is gone
+        self.assertRaises(socket.error, pandocxnos.server.request, path,
+                          ['latex'], data)
+
+
+    def test_request_2(self):
+        """Tests Server and request() #2."""
+
+        tmpdir = tempfile.mkdtemp()
+        environ = os.environ.copy()
+        try:
+            # The default socket is in a private directory
+            os.environ.pop('XNOS_SOCKET', None)
+            os.environ['XDG_RUNTIME_DIR'] = os.path.join(tmpdir, 'missing')
+            os.environ['TMPDIR'] = tmpdir
+            tempfile.tempdir = None
+            path = pandocxnos.server.get_path()
+            self.assertEqual(os.path.dirname(os.path.dirname(path)), tmpdir)
+            server = pandocxnos.server.Server(path, [])
+            try:
+                self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777,
+                                 0o700)
+
+                # Sockets that others may access aren't used
+                os.chmod(path, 0o777)
+                self.assertRaises(socket.error, pandocxnos.server.request,
+                                  path, [], b'{}')
+            finally:
+                server.server_close()
+
+            # ... nor is a runtime directory
+            os.environ['XDG_RUNTIME_DIR'] = tmpdir
+            self.assertEqual(pandocxnos.server.get_path(),
+                             os.path.join(tmpdir, 'pandoc-xnos.sock'))
+
+            # Only sockets are removed
+            path = os.path.join(tmpdir, 'file')
+            with open(path, 'w') as f:
+                f.write('foo')
+            self.assertRaises(RuntimeError, pandocxnos.server.Server, path,
+                              [])
+            self.assertTrue(os.path.exists(path))
+
+            # A silent server times out
+            path = os.path.join(tmpdir, 'silent.sock')
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            umask = os.umask(0o077)
+            try:
+                sock.bind(path)
+            finally:
+                os.umask(umask)
+            sock.listen(1)
+            try:
+                self.assertRaises(socket.error, pandocxnos.server.request,
+                                  path, [], b'{}', 0.1)
+            finally:
+                sock.close()
+
+            # Sockets in directories that others may access aren't used
+            shared = os.path.join(tmpdir, 'shared')
+            os.mkdir(shared)
+            os.chmod(shared, 0o755)
+            path = os.path.join(shared, 'xnos.sock')
+            self.assertRaises(RuntimeError, pandocxnos.server.Server, path,
+                              [])
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            umask = os.umask(0o077)
+            try:
+                sock.bind(path)
+            finally:
+                os.umask(umask)
+            sock.listen(1)
+            try:
+                self.assertRaises(socket.error, pandocxnos.server.request,
+                                  path, [], b'{}', 0.1)
+            finally:
+                sock.close()
+
+            # The user's own server passes the peer check
+            # pylint: disable=protected-access
+            socks = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                pandocxnos.server._check_peer(socks[0])
+            finally:
+                for sock in socks:
+                    sock.close()
+
+            # Only the environment variables that the filters read are sent
+            self.assertEqual(pandocxnos.server._get_environ(
+                {'XNOS_TEST':'1', 'LC_ALL':'C', 'PANDOC_VERSION':'3.1',
+                 'SSH_AUTH_SOCK':'/tmp/agent'}),
+                             {'XNOS_TEST':'1', 'LC_ALL':'C',
+                              'PANDOC_VERSION':'3.1'})
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            tempfile.tempdir = None
+            shutil.rmtree(tmpdir)
+
+
+class TestBatch(unittest.TestCase):
+    """Test the pandocxnos.batch module."""
+
+    def test_run_batch(self):
+        """Tests find_files() and run_batch()."""
+
+        src = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # Hand-coded
+        expected = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"},{"t":"Str","c":"html"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # A plugin that appends the format and alters the state kept by
+        # core.py
+        plugin = types.ModuleType('plugin')
+        def filter_doc(doc, fmt):
+            """Appends the format to the first block."""
+            # pylint: disable=protected-access
+            if pandocxnos.core._CLEVEREFTEX:
+                raise RuntimeError('State leaked between documents')
+            pandocxnos.core._CLEVEREFTEX = True
+            doc['blocks'][0]['c'].append({'t':'Str', 'c':fmt})
+            return doc
+        plugin.filter_doc = filter_doc
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            indir = os.path.join(tmpdir, 'in')
+            os.makedirs(os.path.join(indir, 'b'))
+            names = ['a.json', os.path.join('b', 'c.json'),
+                     os.path.join('b', 'd.json')]
+            for name in names:
+                with open(os.path.join(indir, name), 'w') as f:
+                    json.dump(src, f)
+            with open(os.path.join(indir, 'b', 'e.txt'), 'w') as f:
+                f.write('Not json')
+
+            for processes in [1, 2]:
+                outdir = os.path.join(tmpdir, 'out%d' % processes)
+                files = pandocxnos.batch.find_files([indir], outdir)
+                self.assertEqual(files,
+                                 [(os.path.join(indir, name),
+                                   os.path.join(outdir, name))
+                                  for name in names])
+                self.assertEqual(
+                    pandocxnos.batch.run_batch(files, 'html', [plugin],
+                                               processes), [])
+                for name in names:
+                    with open(os.path.join(outdir, name)) as f:
+                        self.assertEqual(json.load(f), expected)
+                self.assertFalse(pandocxnos.core._CLEVEREFTEX)  # pylint: disable=protected-access
+
+            # Failures are reported and don't stop the batch
+            path = os.path.join(indir, 'b', 'e.txt')
+            outdir = os.path.join(tmpdir, 'out')
+            files = pandocxnos.batch.find_files([path, indir], outdir)
+            errors = pandocxnos.batch.run_batch(files, 'html', [plugin])
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(errors[0].startswith(path))
+            with open(os.path.join(outdir, 'a.json')) as f:
+                self.assertEqual(json.load(f), expected)
+
+            # Files are neither overwritten nor written twice
+            self.assertRaises(RuntimeError, pandocxnos.batch.find_files,
+                              [indir], indir)
+            self.assertRaises(RuntimeError, pandocxnos.batch.find_files,
+                              [os.path.join(indir, 'b', 'c.json'),
+                               os.path.join(outdir, 'b', 'c.json')], outdir)
+            self.assertRaises(RuntimeError, pandocxnos.batch.find_files,
+                              [indir, os.path.join(tmpdir, 'out1')], outdir)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_run_batch_2(self):
+        """Tests run_batch() #2."""
+
+        src = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # Hand-coded
+        expected = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"},{"t":"Str","c":"latex"},{"t":"Str","c":"1"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        # A plugin that only provides main(), which appends the format from
+        # its arguments and counts the documents it filters
+        plugin = types.ModuleType('plugin')
+        plugin.count = 0
+        def main():
+            """Appends the format and count to the first block."""
+            plugin.count += 1
+            doc = json.loads(plugin.STDIN.read())
+            doc['blocks'][0]['c'].append({'t':'Str', 'c':sys.argv[1]})
+            doc['blocks'][0]['c'].append({'t':'Str', 'c':str(plugin.count)})
+            json.dump(doc, plugin.STDOUT)
+        plugin.main = main
+        plugin.STDIN, plugin.STDOUT = pandocxnos.STDIN, pandocxnos.STDOUT
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            names = ['a.json', 'b.json', 'c.json']
+            for name in names:
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    json.dump(src, f)
+
+            # The plugin's state doesn't carry over from one file to the next
+            for processes in [1, 2]:
+                outdir = os.path.join(tmpdir, 'out%d' % processes)
+                files = pandocxnos.batch.find_files(
+                    [os.path.join(tmpdir, name) for name in names], outdir)
+                self.assertEqual(
+                    pandocxnos.batch.run_batch(files, 'latex', [plugin],
+                                               processes), [])
+                for name in names:
+                    with open(os.path.join(outdir, name)) as f:
+                        self.assertEqual(json.load(f), expected)
+                self.assertEqual(plugin.count, 0)
+
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_main(self):
+        """Tests main()."""
+
+        src = eval(r'''{"blocks":[{"t":"Para","c":[{"t":"Str","c":"foo"}]}],"pandoc-api-version":[1,17,0,4],"meta":{}}''')
+
+        tmpdir = tempfile.mkdtemp()
+        argv, cwd = sys.argv, os.getcwd()
+        environ = os.environ.copy()
+        try:
+            indir = os.path.join(tmpdir, 'in')
+            os.makedirs(os.path.join(indir, 'b'))
+            for name in ['a.json', os.path.join('b', 'c.json')]:
+                with open(os.path.join(indir, name), 'w') as f:
+                    json.dump(src, f)
+
+            # The manifest is utf-8, and its paths are relative to it
+            with io.open(os.path.join(indir, 'manifest.txt'), 'w',
+                         encoding='utf-8') as f:
+                f.write(u'a.json\n\nb/c.json\n')
+            os.chdir(tmpdir)
+            os.environ['XNOS_PLUGINS'] = ','  # No plugins
+            sys.argv = ['pandoc-xnos-batch', '-o', 'out', '-m',
+                        os.path.join('in', 'manifest.txt')]
+            pandocxnos.batch.main()
+            for name in ['a.json', 'c.json']:
+                with open(os.path.join(tmpdir, 'out', name)) as f:
+                    self.assertEqual(json.load(f), src)
+
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(tmpdir)
+
+
 #-----------------------------------------------------------------------------
 # main()
 
@@ -713,6 +2090,9 @@ def main():
     suite = unittest.TestSuite()
     suite.addTests(unittest.makeSuite(TestXnos))
     suite.addTests(unittest.makeSuite(TestPandocAttributes))
+    suite.addTests(unittest.makeSuite(TestHost))
+    suite.addTests(unittest.makeSuite(TestServer))
+    suite.addTests(unittest.makeSuite(TestBatch))
     result = unittest.TextTestRunner(verbosity=1).run(suite)
     n_errors = len(result.errors)
     n_failures = len(result.failures)